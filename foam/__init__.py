@@ -1,36 +1,130 @@
+from dataclasses import dataclass
+from hashlib import blake2b
 from typing import Any
-from json import load as jsload
 from json import dumps as jsdumps
-from concurrent.futures import ThreadPoolExecutor, Future
+from asyncio import FIRST_COMPLETED, wrap_future
+from asyncio import wait as async_wait
+from collections.abc import AsyncIterator, Iterator
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, Future
+from concurrent.futures import as_completed as futures_as_completed
 from concurrent.futures import wait as future_wait
-from trimesh.primitives import Sphere as TMSphere
+from multiprocessing import Event as MPEvent
+from time import monotonic, process_time
+from resource import getrusage, RUSAGE_CHILDREN
+from functools import partial
+from heapq import heappop, heappush
+from itertools import count, product, zip_longest
+from threading import RLock
 
+from .tracing import *
 from .utility import *
 from .external import *
 from .model import *
+from .database import *
+from .primitive import *
+from .evaluation import *
+from .kinematics import *
 
 from trimesh.transformations import compose_matrix, euler_matrix, translation_matrix, quaternion_matrix
 
 
-def smooth_manifold(mesh: Trimesh, manifold_leaves: int = 1000, ratio = 0.2) -> Trimesh:
-    mesh = manifold(mesh, manifold_leaves)
-    mesh = simplify_manifold(mesh, ratio)
-    smooth_mesh(mesh)
+def stage_timeout(stage: str, timeouts: dict[str, float] = {}, deadline: float | None = None) -> float | None:
+    # Each external stage gets its own limit, further capped by whatever is left of the job's overall deadline.
+    timeout = timeouts.get(stage)
+    if deadline is not None:
+        remaining = max(deadline - monotonic(), 0.)
+        timeout = remaining if timeout is None else min(timeout, remaining)
+
+    return timeout
+
+
+def smooth_manifold(
+        mesh: Trimesh | MeshFile,
+        manifold_leaves: int = 1000,
+        ratio = 0.2,
+        timeouts: dict[str, float] = {},
+        deadline: float | None = None,
+        smoothing_tolerance: float = 1e-5,
+        smoothing_faces: int | None = None,
+    ) -> Trimesh:
+    with span('manifold', leaves = manifold_leaves) as stage:
+        manifold_mesh = manifold(
+            mesh,
+            manifold_leaves,
+            load = False,
+            timeout = stage_timeout('manifold', timeouts, deadline),
+            )
+
+        # Intermediate meshes stay on disk, so they are only parsed to report their size when tracing.
+        if tracing_enabled():
+            stage.set(
+                input = mesh_size(mesh if isinstance(mesh, Trimesh) else mesh.load()),
+                output = mesh_size(manifold_mesh.load()),
+                )
+
+    with manifold_mesh, span('simplify', ratio = ratio) as stage:
+        mesh = simplify_manifold(manifold_mesh, ratio, timeout = stage_timeout('simplify', timeouts, deadline))
+        stage.set(output = mesh_size(mesh))
+
+    # Smoothing, and the spherization after it, can run on a coarser copy of the manifold mesh instead.
+    if smoothing_faces is not None and len(mesh.faces) > smoothing_faces:
+        with span('simplify', ratio = smoothing_faces / len(mesh.faces)) as stage:
+            try:
+                mesh = simplify(
+                    mesh,
+                    smoothing_faces / len(mesh.faces),
+                    timeout = stage_timeout('simplify', timeouts, deadline),
+                    )
+            except ExternalFailureError:
+                pass
+
+            stage.set(output = mesh_size(mesh))
+
+    stats = smooth_mesh(mesh, tolerance = smoothing_tolerance)
+    converged = "converged" if stats.displacement <= smoothing_tolerance else "did not converge"
+    print(
+        f"Smoothing {converged} after {stats.iterations} iterations in {stats.seconds:.2f}s "
+        f"(last displacement {stats.displacement:.2e})"
+        )
 
     return mesh
 
 
-def spherize_mesh(
-    name: str,
+def decimate_mesh(
+        mesh: Trimesh,
+        face_budget: int,
+        tolerance: float = 0.005,
+        samples: int = 20000,
+        timeout: float | None = None,
+    ) -> Trimesh:
+    # Simplifies a mesh above the face budget down to it, as long as the surface moves by at most `tolerance` times
+    # the bounding box diagonal. Each time the deviation is too large the target face count is doubled, and the
+    # original mesh is kept if nothing below it fits.
+    faces = len(mesh.faces)
+    max_deviation = tolerance * np.linalg.norm(mesh.extents)
+    ratio = face_budget / faces
+
+    with span('decimate', input = faces, budget = face_budget) as stage:
+        while ratio < 1.:
+            simplified = simplify(mesh, ratio, timeout = timeout)
+            deviation = mesh_hausdorff(mesh, simplified, samples)
+            if deviation <= max_deviation:
+                stage.set(output = len(simplified.faces), ratio = ratio, deviation = deviation)
+                return simplified
+
+            ratio *= 2.
+
+        stage.set(output = faces)
+
+    return mesh
+
+
+def prepare_mesh(
     mesh: Trimesh | Path,
     scale: NDArray | None = None,
     position: NDArray | None = None,
     orientation: NDArray | None = None,
-    spherization_kwargs: dict[str, Any] = {},
-    process_kwargs: dict[str, Any] = {},
-) -> list[Spherization]:
-
-    print(f"Spherizing {name}")
+) -> tuple[Trimesh, NDArray]:
     if isinstance(mesh, Path):
         print(f"Processing {mesh}")
         loaded_mesh = load_mesh_file(mesh)
@@ -40,19 +134,6 @@ def spherize_mesh(
 
     loaded_mesh = loaded_mesh.copy()
 
-    if isinstance(mesh, TMSphere):
-        x, y, z = mesh.center
-        r = mesh.primitive.radius
-        return [
-            Spherization(
-                spheres=[Sphere(x, y, z, r)],
-                mean_error=0.0,
-                best_error=0.0,
-                worst_error=0.0,
-            )
-        ] * (spherization_kwargs["depth"] + 1)
-        # NOTE: Because depth seems to be 0-indexed and determines the number of fineness levels for the spherization
-
     if position is not None or orientation is not None:
         tf = compose_matrix(angles=orientation, translate=position)
         loaded_mesh.apply_transform(tf)
@@ -65,35 +146,476 @@ def spherize_mesh(
     offset = (high_bounds + low_bounds) / 2
     loaded_mesh.apply_transform(translation_matrix(-offset))
 
-    method = spherization_kwargs['method']
-    if not check_valid_for_spherization(method, loaded_mesh):
-        loaded_mesh = smooth_manifold(loaded_mesh, **process_kwargs)
+    return loaded_mesh, offset
+
+
+def split_instance_transform(
+    scale: NDArray | None = None,
+    position: NDArray | None = None,
+    orientation: NDArray | None = None,
+) -> tuple[NDArray | None, NDArray | None, NDArray | None, NDArray]:
+    # Rigid transforms and uniform scales map spheres to spheres exactly, so a mesh only needs spherizing once in
+    # its own (scaled) frame, and each instance then moves the cached spheres into place. `prepare_mesh` scales
+    # after transforming, so the instance translation is scaled as well. A non-uniform scale does not commute with
+    # a rotation, so in that case the full transform is baked into the mesh as before.
+    scale_vector = np.ones(3) if scale is None else np.broadcast_to(scale, (3, ))
+    translation = np.zeros(3) if position is None else np.asarray(position)
+    angles = np.zeros(3) if orientation is None else np.asarray(orientation)
+
+    if np.allclose(scale_vector, scale_vector[0]) or not np.any(angles):
+        return scale, None, None, compose_matrix(angles = angles, translate = scale_vector * translation)
+
+    return scale, position, orientation, np.eye(4)
+
+
+# Bump whenever a change to the pipeline invalidates previously cached spherizations.
+SPHERIZATION_CACHE_VERSION = 2
+
+
+def spherization_key(
+    mesh_digest: str,
+    spherization_kwargs: dict[str, Any] = {},
+    process_kwargs: dict[str, Any] = {},
+) -> str:
+    parameters = jsdumps(
+        {
+            'version': SPHERIZATION_CACHE_VERSION,
+            'spherization': spherization_kwargs,
+            'process': process_kwargs,
+            },
+        sort_keys = True,
+        )
+
+    digest = blake2b(digest_size = 16)
+    digest.update(mesh_digest.encode())
+    digest.update(parameters.encode())
+    return digest.hexdigest()
+
+
+# Whether a mesh could be spherized as-is, needed to go through `smooth_manifold` first, or could not be
+# spherized at all. Verdicts are cached per mesh, method and processing settings so repeat runs skip straight to
+# the right path.
+VALID = "valid"
+NEEDS_MANIFOLD = "manifold"
+UNRECOVERABLE = "unrecoverable"
+
+# Processing settings that only pick the branching factor, and so cannot change a verdict.
+BRANCH_KWARGS = ('volume_heuristic_ratio', 'branch_scale')
+
+
+def verdict_key(mesh_digest: str, method: str, process_kwargs: dict[str, Any] = {}) -> str:
+    parameters = jsdumps({k: v for k, v in process_kwargs.items() if k not in BRANCH_KWARGS}, sort_keys = True)
+    digest = blake2b(parameters.encode(), digest_size = 8)
+    return f"{mesh_digest}:{method}:{digest.hexdigest()}"
+
+
+# Cheaper settings to retry a job with, in order, when it runs out of time. Every attempt but the last gets
+# `FALLBACK_SHARE` of the time left, so each fallback still has time to run. Only methods that evaluate their
+# trees are fallen back to, since octree and Hubbard trees come without errors to compare them by.
+FALLBACKS = {
+    'medial': [{'initSpheres': 250, 'numCover': 1000}, {'method': 'grid'}, {'method': 'grid', 'numCover': 1000}],
+    'spawn': [{'method': 'grid'}, {'method': 'grid', 'numCover': 1000}],
+    'hubbard': [{'method': 'grid', 'numCover': 1000}],
+    'grid': [{'numCover': 1000}],
+    'octree': [],
+    }
+FALLBACK_SHARE = 0.5
+
+
+def mesh_bounds(mesh: Trimesh) -> tuple[float, float]:
+    # Radius of the mesh's bounding sphere and the mesh's volume, all the branch heuristic needs of a mesh.
+    _, radius = bounding_sphere(mesh)
+    return radius, float(mesh.volume)
+
+
+def heuristic_branch(
+        bounds: tuple[float, float],
+        branch: int = 8,
+        volume_heuristic_ratio: float = 0.7,
+        scale: float = 1.,
+    ) -> int:
+    # Fewer spheres for meshes that already fill most of their bounding sphere.
+    radius, volume = bounds
+    volume_ratio = (4. / 3. * np.pi * radius**3) / volume
+    branch = min(int(volume_ratio * volume_heuristic_ratio), branch)
+    return branch if scale == 1. else int(scale * branch)
+
+
+def branch_heuristic(mesh: Trimesh, branch: int = 8, volume_heuristic_ratio: float = 0.7) -> int:
+    return heuristic_branch(mesh_bounds(mesh), branch, volume_heuristic_ratio)
+
+
+@dataclass
+class SpherizationResult:
+    levels: list[Spherization]
+    verdict: str
+    quality: list[SpherizationQuality] | None = None
+    method: str | None = None    # Method that produced the levels
+    fallback: bool = False       # Whether they come from cheaper settings than asked for
+    bounds: tuple[float, float] | None = None    # See `mesh_bounds`, when the branch heuristic needed them
+
+
+def _spherize_prepared_mesh(
+    mesh: Trimesh,
+    spherization_kwargs: dict[str, Any] = {},
+    process_kwargs: dict[str, Any] = {},
+    verdict: str | None = None,
+    timeouts: dict[str, float] = {},
+    deadline: float | None = None,
+) -> SpherizationResult:
+    # Boxes, cylinders and spheres are packed analytically, without any external process.
+    if is_primitive(mesh):
+        return SpherizationResult(
+            spherize_primitive(mesh, spherization_kwargs["depth"], spherization_kwargs["branch"]),
+            VALID,
+            method = 'primitive',
+        )
+
+    if verdict == UNRECOVERABLE:
+        return SpherizationResult([], UNRECOVERABLE)
 
-    if not check_valid_for_spherization(method, loaded_mesh):
-        raise RuntimeError("Failed to make loaded_mesh valid!")
+    process_kwargs = dict(process_kwargs)
+    face_budget = process_kwargs.pop('face_budget', None)
+    decimation_tolerance = process_kwargs.pop('decimation_tolerance', 0.005)
+    if face_budget is not None and len(mesh.faces) > face_budget:
+        try:
+            mesh = decimate_mesh(
+                mesh,
+                face_budget,
+                decimation_tolerance,
+                timeout = stage_timeout('simplify', timeouts, deadline),
+                )
+        except ExternalFailureError:
+            pass
+
+    # The real run doubles as the validity check, so it must verify the mesh unless we already know it is fine.
+    # Both attempts read the same serialized copy of the mesh.
+    with MeshFile(mesh) as mesh_file:
+        if verdict != NEEDS_MANIFOLD:
+            try:
+                return SpherizationResult(
+                    compute_spheres(
+                        mesh_file,
+                        stage_timeout('makeTree', timeouts, deadline),
+                        **(spherization_kwargs | {'verify': True}),
+                    ),
+                    VALID,
+                )
+            except ExternalFailureError:
+                pass
+
+        try:
+            mesh = smooth_manifold(mesh_file, **process_kwargs, timeouts = timeouts, deadline = deadline)
+            return SpherizationResult(
+                compute_spheres(mesh, stage_timeout('makeTree', timeouts, deadline), **spherization_kwargs),
+                NEEDS_MANIFOLD,
+            )
 
-    try:
-        spheres = compute_spheres(loaded_mesh, **spherization_kwargs)
+        # Only a mesh the binaries reject is unrecoverable; anything else fails this run alone and is not cached.
+        except ExternalFailureError:
+            return SpherizationResult([], UNRECOVERABLE)
+
+
+def _spherize_with_fallback(
+    mesh: Trimesh,
+    spherization_kwargs: dict[str, Any] = {},
+    process_kwargs: dict[str, Any] = {},
+    verdict: str | None = None,
+    timeouts: dict[str, float] = {},
+    deadline: float | None = None,
+) -> SpherizationResult:
+    method = spherization_kwargs.get('method', 'medial')
+    attempts = [{}] + (FALLBACKS.get(method, []) if deadline is not None else [])
+
+    for i, overrides in enumerate(attempts):
+        attempt_kwargs = spherization_kwargs | overrides
+        attempt_method = attempt_kwargs.get('method', 'medial')
+
+        attempt_deadline = deadline
+        if i < len(attempts) - 1:
+            attempt_deadline = monotonic() + max(deadline - monotonic(), 0.) * FALLBACK_SHARE # type: ignore
 
-    except:
         try:
-            loaded_mesh = smooth_manifold(loaded_mesh, **process_kwargs)
-            spheres = compute_spheres(loaded_mesh, **spherization_kwargs)
+            result = _spherize_prepared_mesh(
+                mesh,
+                attempt_kwargs,
+                process_kwargs,
+                verdict if attempt_method == method else None,
+                timeouts,
+                attempt_deadline,
+                )
+        except ExternalTimeoutError:
+            if i == len(attempts) - 1:
+                raise
+
+            print(f"{attempt_method} ran out of time, retrying with {attempts[i + 1]}")
+            continue
+
+        if result.method is None:
+            result.method = attempt_method
+
+        result.fallback = bool(overrides)
+        return result
+
+
+def spherize_prepared_mesh(
+    mesh: Trimesh,
+    spherization_kwargs: dict[str, Any] = {},
+    process_kwargs: dict[str, Any] = {},
+    verdict: str | None = None,
+    timeouts: dict[str, float] = {},
+    deadline: float | None = None,
+    evaluate: bool = False,
+    budget: float | None = None,
+    bounds: tuple[float, float] | None = None,
+) -> SpherizationResult:
+    # `deadline` is absolute (on the `monotonic` clock, which processes share), e.g. for a whole URDF, while
+    # `budget` is in seconds from when the job actually starts. With either, jobs that run out of time are retried
+    # with cheaper settings from `FALLBACKS`.
+    if budget is not None:
+        deadline = monotonic() + budget if deadline is None else min(deadline, monotonic() + budget)
+
+    # With a `volume_heuristic_ratio`, `branch` is only an upper bound and the mesh decides the rest. The mesh's
+    # bounds are worked out here, in the worker, unless an earlier run already did.
+    process_kwargs = dict(process_kwargs)
+    volume_heuristic_ratio = process_kwargs.pop('volume_heuristic_ratio', None)
+    branch_scale = process_kwargs.pop('branch_scale', 1.)
+    if volume_heuristic_ratio is not None:
+        if bounds is None:
+            with span('bounds', **mesh_size(mesh)):
+                bounds = mesh_bounds(mesh)
+
+        branch = heuristic_branch(bounds, spherization_kwargs['branch'], volume_heuristic_ratio, branch_scale)
+        spherization_kwargs = spherization_kwargs | {'branch': branch}
+
+    with span('spherize', method = spherization_kwargs.get('method', 'medial'), **mesh_size(mesh)) as stage:
+        result = _spherize_with_fallback(mesh, spherization_kwargs, process_kwargs, verdict, timeouts, deadline)
+        stage.set(verdict = result.verdict, spheres = [len(level) for level in result.levels], used = result.method)
+
+    result.bounds = bounds
+
+    for level in result.levels:
+        level.method = result.method
+
+    # Quality is always measured against the mesh as given, not its manifold replacement.
+    if evaluate and result.levels:
+        with span('evaluate'):
+            result.quality = [evaluate_spherization(mesh, level) for level in result.levels]
+
+        for level, quality in enumerate(result.quality):
+            print(f"Level {level}: {quality}")
+
+    return result
+
 
-        except:
-            raise RuntimeError("Failed to process loaded_mesh.")
+def spherize_mesh_file(
+    mesh_filepath: Path,
+    scale: NDArray | None = None,
+    position: NDArray | None = None,
+    orientation: NDArray | None = None,
+    spherization_kwargs: dict[str, Any] = {},
+    process_kwargs: dict[str, Any] = {},
+    verdict: str | None = None,
+    timeouts: dict[str, float] = {},
+    deadline: float | None = None,
+    evaluate: bool = False,
+    budget: float | None = None,
+    bounds: tuple[float, float] | None = None,
+) -> SpherizationResult:
+    # Loads the mesh in the worker, so the process that queued the job never holds it. The spheres are moved
+    # out of the centered frame, since only the worker knows the offset.
+    mesh, offset = prepare_mesh(mesh_filepath, scale, position, orientation)
+    result = spherize_prepared_mesh(
+        mesh,
+        spherization_kwargs,
+        process_kwargs,
+        verdict,
+        timeouts,
+        deadline,
+        evaluate,
+        budget,
+        bounds,
+        )
+    for level in result.levels:
+        level.offset(offset)
+
+    return result
+
+
+def spherize_mesh(
+    name: str,
+    mesh: Trimesh | Path,
+    scale: NDArray | None = None,
+    position: NDArray | None = None,
+    orientation: NDArray | None = None,
+    spherization_kwargs: dict[str, Any] = {},
+    process_kwargs: dict[str, Any] = {},
+) -> list[Spherization]:
+
+    print(f"Spherizing {name}")
+    loaded_mesh, offset = prepare_mesh(mesh, scale, position, orientation)
+    result = spherize_prepared_mesh(loaded_mesh, spherization_kwargs, process_kwargs)
+    if result.verdict == UNRECOVERABLE:
+        raise RuntimeError("Failed to process loaded_mesh.")
 
+    spheres = [sphere.copy() for sphere in result.levels]
     for sphere in spheres:
         sphere.offset(offset)
 
     return spheres
 
 
+# Relative cost of each makeTree method, used only to order jobs.
+METHOD_COST = {'octree': 1., 'grid': 2., 'hubbard': 2., 'spawn': 4., 'medial': 8.}
+
+
+def estimate_cost(mesh: Trimesh | Path, spherization_kwargs: dict[str, Any] = {}) -> float:
+    if isinstance(mesh, Trimesh) and is_primitive(mesh):
+        return 0.
+
+    if isinstance(mesh, Path):
+        # Unloaded meshes are ranked by file size as a stand-in for face count.
+        faces = mesh.stat().st_size / 50.
+        elongation = 1.
+    else:
+        faces = len(mesh.faces)
+        extents = np.maximum(mesh.extents, 1e-6)
+        elongation = 1. + np.log(extents.max() / np.cbrt(np.prod(extents)))
+
+    method = spherization_kwargs.get('method', 'medial')
+    if method == 'hubbard':
+        samples = spherization_kwargs.get('num_samples', 500)
+    elif method == 'octree':
+        samples = 0
+    else:
+        samples = spherization_kwargs.get('numCover', 5000)
+
+    branch = spherization_kwargs.get('branch', 8)
+    depth = spherization_kwargs.get('depth', 1)
+    tree_size = sum(branch**level for level in range(1, depth + 1))
+
+    return METHOD_COST.get(method, METHOD_COST['medial']) * (faces + samples) * np.log2(2 + tree_size) * elongation
+
+
+def initialize_worker(cancel_event, mesh_cache_dir: Path | None):
+    # Workers started with spawn or forkserver do not inherit module state, so it is handed over explicitly.
+    set_cancel_event(cancel_event)
+    set_mesh_cache_dir(mesh_cache_dir)
+
+
 class ParallelSpherizer:
+    # Jobs are queued with an estimated cost and handed to the worker pool longest-first, one per free worker,
+    # so a large mesh never ends up alone at the tail of a run. Dispatch begins on `start`, or implicitly on the
+    # first `wait`/`get`, so every job submitted up to then is ranked together.
+
+    def __init__(self, threads: int = 4, processes: bool = True):
+        self.cancel_event = MPEvent()
+        if processes:
+            self.executor = ProcessPoolExecutor(
+                max_workers = threads,
+                initializer = initialize_worker,
+                initargs = (self.cancel_event, get_mesh_cache_dir()),
+                )
+        else:
+            self.executor = ThreadPoolExecutor(
+                max_workers = threads,
+                initializer = initialize_worker,
+                initargs = (self.cancel_event, get_mesh_cache_dir()),
+                )
+
+        self.workers = threads
+        self.processes = processes
+        self.running = 0
+        self.started = False
+        self.pending = []
+        self.counter = count()
+        self.lock = RLock()
+        self.waiting: dict[str, Future] = {}
+
+    def submit(self, key: str, fn, *args, cost: float = 0.) -> Future:
+        future = Future()
+        with self.lock:
+            self.waiting[key] = future
+            heappush(self.pending, (-cost, next(self.counter), key, fn, args, future))
+
+        if self.started:
+            self._dispatch()
+
+        return future
+
+    def _dispatch(self):
+        with self.lock:
+            while self.pending and self.running < self.workers:
+                *_, key, fn, args, future = heappop(self.pending)
+                if not future.set_running_or_notify_cancel():
+                    continue
+
+                # The pool may already be shut down at interpreter exit, after a failure ended the run early.
+                try:
+                    job = self.executor.submit(traced_call, fn, args, tracing_enabled(), self.processes, key)
+                except RuntimeError as e:
+                    future.set_exception(e)
+                    continue
+
+                self.running += 1
+                job.add_done_callback(partial(self._finish, future))
+
+    def _finish(self, future: Future, job: Future):
+        with self.lock:
+            self.running -= 1
+
+        try:
+            result, spans = job.result()
+            if spans:
+                add_spans(spans)
 
-    def __init__(self, threads: int = 4):
-        self.executor = ThreadPoolExecutor(max_workers = threads)
-        self.waiting = {}
+            future.set_result(result)
+        except BaseException as e:
+            future.set_exception(e)
+
+        self._dispatch()
+
+    def run_inline(self, key: str, fn, *args) -> Future:
+        # For jobs too cheap to be worth a trip through the pool.
+        future = Future()
+        try:
+            with span('job', key = key):
+                future.set_result(fn(*args))
+        except BaseException as e:
+            future.set_exception(e)
+
+        self.waiting[key] = future
+        return future
+
+    def start(self):
+        self.started = True
+        self._dispatch()
+
+    def cancel(self):
+        # Queued jobs are dropped; external binaries already running in a worker are killed at their next poll.
+        with self.lock:
+            for *_, future in self.pending:
+                future.cancel()
+
+            self.pending.clear()
+
+        self.cancel_event.set()
+
+    def as_completed(self) -> Iterator[tuple[str, Future]]:
+        self.start()
+        keys = {future: key for key, future in self.waiting.items()}
+        for future in futures_as_completed(keys):
+            yield keys[future], future
+
+    async def stream(self) -> AsyncIterator[tuple[str, Future]]:
+        self.start()
+        keys = {future: key for key, future in self.waiting.items()}
+        pending = {wrap_future(future): future for future in keys}
+        while pending:
+            done, _ = await async_wait(pending, return_when = FIRST_COMPLETED)
+            for wrapped in done:
+                future = pending.pop(wrapped)
+                yield keys[future], future
 
     def spherize_mesh(
             self,
@@ -105,7 +627,8 @@ class ParallelSpherizer:
             spherization_kwargs: dict[str, Any] = {},
             process_kwargs: dict[str, Any] = {}
         ) -> Future[list[Spherization]]:
-        future = self.executor.submit(
+        return self.submit(
+            name,
             spherize_mesh,
             name,
             mesh,
@@ -114,76 +637,55 @@ class ParallelSpherizer:
             orientation,
             spherization_kwargs,
             process_kwargs,
-        )
-
-        self.waiting[name] = future
-        return future
+            cost = estimate_cost(mesh, spherization_kwargs),
+            )
 
     def wait(self):
+        self.start()
         future_wait(self.waiting.values())
 
     def get(self, name: str) -> list[Spherization]:
+        self.start()
         return self.waiting[name].result()
 
 
-class SpherizationDatabase:
+def timed_call(fn, *args) -> tuple[Any, float]:
+    # Returns a job's result with the CPU seconds it took, including the external binaries it waited for. Only
+    # exact in a worker process that runs one job at a time.
+    def cpu() -> float:
+        usage = getrusage(RUSAGE_CHILDREN)
+        return process_time() + usage.ru_utime + usage.ru_stime
 
-    def __init__(self, path: Path):
-        self.path = path
+    start = cpu()
+    result = fn(*args)
+    return result, cpu() - start
 
-        if path.exists():
-            with open(path, 'r') as json_file:
-                self.db = jsload(json_file, cls = SphereDecoder)
-                self.db = {
-                    mk: {
-                        int(bk): {
-                            int(dk): dv
-                            for dk, dv in bv.items()
-                            }
-                        for bk, bv in mv.items()
-                        }
-                    for mk,
-                    mv in self.db.items()
-                    }
 
-        else:
-            self.db = {}
-
-    def __del__(self):
-        with open(self.path, 'w') as f:
-            f.write(jsdumps(self.db, indent = 4, cls = SphereEncoder))
-
-    def add(self, mesh: str, branch: int, depth: int, spherization: Spherization):
-        if mesh not in self.db:
-            self.db[mesh] = {}
-
-        if branch not in self.db[mesh]:
-            self.db[mesh][branch] = {}
-
-        if depth not in self.db[mesh][branch]:
-            self.db[mesh][branch][depth] = spherization
-
-        else:
-            if spherization < self.db[mesh][branch][depth]:
-                self.db[mesh][branch][depth] = spherization
-
-    def get(self, mesh: str, branch: int, depth: int) -> Spherization:
-        return self.db[mesh][branch][depth]
+def _sweep_process_kwargs(process_kwargs: dict[str, Any], parameters: dict[str, Any]) -> dict[str, Any]:
+    # A branching factor swept explicitly is used as is, rather than capped again by the volume heuristic.
+    if 'branch' not in parameters:
+        return process_kwargs
 
-    def exists(self, mesh: str, branch: int, depth: int) -> bool:
-        if mesh in self.db:
-            if branch in self.db[mesh]:
-                if depth in self.db[mesh][branch]:
-                    return True
-
-        return False
+    return {k: v for k, v in process_kwargs.items() if k not in BRANCH_KWARGS}
 
 
 class SpherizationHelper:
 
-    def __init__(self, database: Path, threads: int = 8):
-        self.ps = ParallelSpherizer(threads)
+    def __init__(
+            self,
+            database: Path,
+            threads: int = 8,
+            processes: bool = True,
+            timeouts: dict[str, float] = {},
+        ):
+        self.ps = ParallelSpherizer(threads, processes)
         self.db = SpherizationDatabase(database)
+        self.timeouts = timeouts
+        self.keys: dict[str, tuple[str, NDArray]] = {}    # name -> (key, transform from canonical frame)
+        self.quality: dict[str, list[SpherizationQuality]] = {}
+        self.verdict_keys: dict[str, tuple[str, str, dict]] = {}    # key -> (mesh digest, method, kwargs)
+        self.sources: dict[str, tuple[str, tuple, dict, dict]] = {}    # name -> (mesh digest, job, kwargs, kwargs)
+        self.sweep_runs = count()
 
     def spherize_mesh(
             self,
@@ -212,7 +714,15 @@ class SpherizationHelper:
             num_samples: int = 500,
             min_samples: int = 1,
             manifold_leaves: int = 1000,
-            simplification_ratio: float = 0.2
+            simplification_ratio: float = 0.2,
+            face_budget: int | None = None,
+            decimation_tolerance: float = 0.005,
+            smoothing_faces: int | None = None,
+            budget: float | None = None,
+            deadline: float | None = None,
+            volume_heuristic_ratio: float | None = None,
+            branch_scale: float = 1.,
+            queue: bool = True,
         ):
         spherization_kwargs = {
         'depth': depth,
@@ -234,28 +744,404 @@ class SpherizationHelper:
         'num_samples': num_samples,
         'min_samples': min_samples
         }
-        if not self.db.exists(name, branch, depth):
-            self.ps.spherize_mesh(
-                name,
-                mesh,
-                scale,
-                position,
-                orientation,
+        process_kwargs = {
+            'manifold_leaves': manifold_leaves,
+            'ratio': simplification_ratio,
+            }
+
+        # Only part of the key when used, so entries cached without pre-decimation stay valid.
+        if face_budget is not None:
+            process_kwargs |= {'face_budget': face_budget, 'decimation_tolerance': decimation_tolerance}
+
+        if smoothing_faces is not None:
+            process_kwargs |= {'smoothing_faces': smoothing_faces}
+
+        # The worker derives the branching factor from these, so they stand in for it in the key.
+        if volume_heuristic_ratio is not None:
+            process_kwargs |= {'volume_heuristic_ratio': volume_heuristic_ratio, 'branch_scale': branch_scale}
+
+        print(f"Spherizing {name}")
+        scale, position, orientation, instance = split_instance_transform(scale, position, orientation)
+        if isinstance(mesh, Path):
+            # Meshes given by path are keyed by their file and loaded by the worker that spherizes them.
+            with span('hash', mesh = name):
+                mesh_digest = 'file:' + hash_file(mesh, scale, position, orientation)
+
+            job = (spherize_mesh_file, mesh, scale, position, orientation)
+            transform = instance
+        else:
+            with span('prepare', mesh = name):
+                prepared_mesh, offset = prepare_mesh(mesh, scale, position, orientation)
+                mesh_digest = hash_mesh(prepared_mesh)
+
+            job = (spherize_prepared_mesh, prepared_mesh)
+            transform = instance @ translation_matrix(offset)
+
+        key = spherization_key(mesh_digest, spherization_kwargs, process_kwargs)
+        self.keys[name] = (key, transform)
+        self.verdict_keys[key] = (mesh_digest, method, process_kwargs)
+        self.sources[name] = (mesh_digest, job, spherization_kwargs, process_kwargs)
+
+        # Meshes registered only for a `sweep` are not spherized with these parameters.
+        if not queue and not is_primitive(job[1]):
+            return
+
+        # Identical work, whether from another link, robot or an earlier run, is only ever done once.
+        if self.db.exists(key) or key in self.ps.waiting:
+            return
+
+        if is_primitive(job[1]):
+            self.ps.run_inline(
+                key,
+                *job,
                 spherization_kwargs,
-                {
-                    'manifold_leaves': manifold_leaves,
-                    'ratio': simplification_ratio,
-                    },
+                process_kwargs,
+                None,
+                self.timeouts,
+                None,
+                eval,
+                None,
+                self.db.get_bounds(mesh_digest),
                 )
+        else:
+            self._submit(key, mesh_digest, job, spherization_kwargs, process_kwargs, deadline, eval, budget)
 
-    def get_spherization(self, name: str, depth: int = 1, branch: int = 8, cache: bool = True) -> Spherization:
-        if not self.db.exists(name, branch, depth):
-            spherization = self.ps.get(name)
-            if cache:
-                for level, sphere_level in enumerate(spherization):
-                    self.db.add(name, branch, level, sphere_level)
+    def _submit(
+            self,
+            key: str,
+            mesh_digest: str,
+            job: tuple,
+            spherization_kwargs: dict[str, Any],
+            process_kwargs: dict[str, Any],
+            deadline: float | None = None,
+            eval: bool = False,
+            budget: float | None = None,
+        ):
+        self.ps.submit(
+            key,
+            *job,
+            spherization_kwargs,
+            process_kwargs,
+            self.db.get_verdict(verdict_key(mesh_digest, spherization_kwargs['method'], process_kwargs)),
+            self.timeouts,
+            deadline,
+            eval,
+            budget,
+            self.db.get_bounds(mesh_digest),
+            cost = estimate_cost(job[1], spherization_kwargs),
+            )
 
-            return spherization[depth]
+    def cancel(self):
+        self.ps.cancel()
 
-        else:
-            return self.db.get(name, branch, depth)
+    def sweep(
+            self,
+            grid: dict[str, list[Any]],
+            budget: float = 600.,
+            samples: int | None = None,
+            names: list[str] | None = None,
+            seed: int = 0,
+        ) -> dict[str, list[SweepCandidate]]:
+        # Spherizes every registered mesh (or those in `names`) with each combination of the `grid` values, or a
+        # random `samples` of them, and keeps each mesh's Pareto front of sphere count, error and runtime in the
+        # database. No run is started once `budget` CPU seconds are spent; runs already going are finished.
+        combinations = [dict(zip(grid, values)) for values in product(*grid.values())]
+        rng = np.random.default_rng(seed)
+
+        meshes = {}
+        runs = []
+        for name in (self.sources if names is None else names):
+            mesh_digest, job, spherization_kwargs, process_kwargs = self.sources[name]
+            if mesh_digest in meshes or is_primitive(job[1]):
+                continue
+
+            meshes[mesh_digest] = name
+            chosen = combinations
+            if samples is not None and samples < len(combinations):
+                chosen = [combinations[i] for i in rng.choice(len(combinations), samples, replace = False)]
+
+            runs.append([
+                (mesh_digest, job, spherization_kwargs | c, _sweep_process_kwargs(process_kwargs, c), c)
+                for c in chosen
+                ])
+
+        # Meshes take turns, so a budget that runs out still leaves every mesh with some results.
+        queue = [run for turn in zip_longest(*runs) for run in turn if run is not None]
+        queue.reverse()
+
+        candidates: dict[str, list[SweepCandidate]] = {mesh_digest: [] for mesh_digest in meshes}
+        running = {}
+        spent = 0.
+
+        self.ps.start()
+        while queue or running:
+            while queue and len(running) < self.ps.workers and spent < budget:
+                mesh_digest, job, spherization_kwargs, process_kwargs, parameters = queue.pop()
+                future = self.ps.submit(
+                    f"sweep:{next(self.sweep_runs)}",
+                    timed_call,
+                    *job,
+                    spherization_kwargs,
+                    process_kwargs,
+                    self.db.get_verdict(verdict_key(mesh_digest, spherization_kwargs['method'], process_kwargs)),
+                    self.timeouts,
+                    None,
+                    False,
+                    None,
+                    self.db.get_bounds(mesh_digest),
+                    )
+                running[future] = (mesh_digest, parameters)
+
+            if not running:
+                break
+
+            done, _ = future_wait(running, return_when = FIRST_COMPLETED)
+            for future in done:
+                mesh_digest, parameters = running.pop(future)
+                try:
+                    result, runtime = future.result()
+                except MissingBinaryError:
+                    raise
+
+                except Exception as e:
+                    print(f"Sweep run {parameters} failed: {e}")
+                    continue
+
+                spent += runtime
+                candidates[mesh_digest].extend(SweepCandidate(level, parameters, runtime) for level in result.levels)
+
+        return {
+            name: self.db.add_candidates(mesh_digest, candidates[mesh_digest])
+            for mesh_digest, name in meshes.items()
+            }
+
+    def _levels(self, name: str, cache: bool = True) -> list[Spherization]:
+        key, _ = self.keys[name]
+        if self.db.exists(key):
+            return self.db.get(key)
+
+        # Meshes registered only for a `sweep` are spherized with their own parameters once they are asked for,
+        # e.g. when no sweep result fits.
+        if key not in self.ps.waiting:
+            mesh_digest, job, spherization_kwargs, process_kwargs = self.sources[name]
+            self._submit(key, mesh_digest, job, spherization_kwargs, process_kwargs)
+
+        result = self.ps.get(key)
+
+        # Verdicts belong to the method that actually ran.
+        mesh_digest, method, process_kwargs = self.verdict_keys[key]
+        if result.method in METHOD_COST:
+            method = result.method
+
+        self.db.set_verdict(verdict_key(mesh_digest, method, process_kwargs), result.verdict)
+        if result.bounds is not None:
+            self.db.set_bounds(mesh_digest, result.bounds)
+
+        if result.verdict == UNRECOVERABLE:
+            raise RuntimeError(f"Failed to process {name}.")
+
+        if result.quality is not None:
+            self.quality[key] = result.quality
+
+        # Results of a fallback stand in for this run only; the next run tries the requested settings again.
+        if cache and not result.fallback:
+            self.db.add(key, result.levels)
+
+        return result.levels
+
+    def get_spherization(
+            self,
+            name: str,
+            depth: int = 1,
+            branch: int = 8,
+            cache: bool = True,
+            target_count: int | None = None,
+            target_error: float | None = None,
+        ) -> Spherization:
+        # With a target, the spherization is picked from the mesh's sweep results when it has any.
+        key, transform = self.keys[name]
+        if target_count is not None or target_error is not None:
+            front = self.db.get_front(self.sources[name][0])
+            if front:
+                spherization = select_candidate(front, target_count, target_error).spherization.copy()
+                spherization.transform(transform)
+                return spherization
+
+        spherization = self._levels(name, cache)[depth].copy()
+        spherization.transform(transform)
+        return spherization
+
+    def get_hierarchy(
+            self,
+            name: str,
+            depth: int = 1,
+            cache: bool = True,
+            target_count: int | None = None,
+            target_error: float | None = None,
+        ) -> list[Spherization]:
+        # Levels 0 to `depth` of the mesh's sphere-tree, each linked to the one before by `parents`. Sweep results
+        # picked by a target are single levels.
+        key, transform = self.keys[name]
+        levels = None
+        if target_count is not None or target_error is not None:
+            front = self.db.get_front(self.sources[name][0])
+            if front:
+                levels = [select_candidate(front, target_count, target_error).spherization]
+
+        if levels is None:
+            levels = self._levels(name, cache)[:depth + 1]
+
+        levels = [level.copy() for level in levels]
+        for level in levels:
+            level.transform(transform)
+
+        return levels
+
+    def get_quality(self, name: str, cache: bool = True) -> list[SpherizationQuality] | None:
+        # Per-level quality of the mesh's spherization, measured only when it was spherized with `eval` in this
+        # run rather than read from the database.
+        key, _ = self.keys[name]
+        if key not in self.quality and key in self.ps.waiting:
+            self._levels(name, cache)
+
+        return self.quality.get(key)
+
+
+@dataclass
+class URDFSpherization:
+    urdf: URDFDict
+    output: Path
+    names: dict[str, tuple[str, bool]]    # URDF collision name -> (helper name, whether to cache it)
+    depth: int = 1
+    branch: int = 8
+    target_count: int | None = None       # Pick from sweep results by sphere count or error instead
+    target_error: float | None = None
+    hierarchy: Path | None = None         # Where to also save every link's sphere hierarchy
+    prune: float | None = None            # Drop spheres inside others of their link, grown by this tolerance
+    precision: int = 6                    # Decimals of sphere positions and radii in the URDF
+    bank: Path | None = None              # Where to also save the spheres as a `.npz` sphere bank
+    header: Path | None = None            # Where to also save the spheres as a C/C++ header
+
+
+def _queue_collision(
+        sh: SpherizationHelper,
+        name: str,
+        collision: URDFMesh | URDFPrimitive,
+        depth: int,
+        branch: int,
+        volume_heuristic_ratio: float,
+        link_scales: dict[str, float],
+        spherize_kwargs: dict[str, Any],
+    ):
+    # The branch heuristic runs in the worker, so only the mesh's path is needed here.
+    link = collision.name.split(":")[0]
+    print(f"Link::Mesh: {collision.name}\n  Target Spheres: at most {branch}")
+
+    sh.spherize_mesh(
+        name,
+        collision.mesh,
+        collision.scale,
+        collision.xyz,
+        orientation = collision.rpy,
+        depth = depth,
+        branch = branch,
+        volume_heuristic_ratio = volume_heuristic_ratio,
+        branch_scale = link_scales.get(link, 1.),
+        **spherize_kwargs,
+        )
+
+
+def queue_urdf(
+        sh: SpherizationHelper,
+        filename: Path,
+        output: Path,
+        depth: int = 1,
+        branch: int = 8,
+        shrinkage: float = 1.,
+        volume_heuristic_ratio: float = 0.7,
+        link_scales: dict[str, float] = {},
+        urdf_budget: float | None = None,
+        **spherize_kwargs,
+    ) -> URDFSpherization:
+    # Queues every collision of a URDF on the helper. Names are prefixed with the URDF's path so several URDFs can
+    # share one helper; identical meshes across them are still spherized only once. With `urdf_budget`, every
+    # collision must be done within that many seconds from now, falling back to cheaper settings if needed.
+    urdf = load_urdf(filename)
+    job = URDFSpherization(urdf, output, {}, depth, branch)
+    if urdf_budget is not None:
+        spherize_kwargs['deadline'] = monotonic() + urdf_budget
+
+    # Meshes are queued as they are found and only ever loaded by the workers.
+    for mesh in iter_urdf_meshes(urdf, shrinkage):
+        name = f"{filename}::{mesh.name}"
+        job.names[mesh.name] = (name, True)
+        _queue_collision(sh, name, mesh, depth, branch, volume_heuristic_ratio, link_scales, spherize_kwargs)
+
+    for primitive in get_urdf_primitives(urdf, shrinkage):
+        name = f"{filename}::{primitive.name}"
+        job.names[primitive.name] = (name, False)
+        _queue_collision(sh, name, primitive, depth, branch, volume_heuristic_ratio, link_scales, spherize_kwargs)
+
+    return job
+
+
+def write_urdf(sh: SpherizationHelper, job: URDFSpherization):
+    spheres = {
+        name: sh.get_spherization(helper_name, job.depth, job.branch, cache, job.target_count, job.target_error)
+        for name, (helper_name, cache) in job.names.items()
+        }
+
+    if job.prune is not None:
+        spheres, reports = prune_link_spheres(spheres, job.prune)
+        for link, report in reports.items():
+            if report.removed:
+                print(
+                    f"{link}: pruned {report.removed} of {report.removed + report.remaining} spheres, "
+                    f"{report.coverage:.2%} of their volume still covered"
+                    )
+
+    save_spherized_urdf(job.urdf, spheres, job.output, job.precision)
+
+    if job.bank is not None:
+        save_sphere_bank(job.urdf, spheres, job.bank)
+
+    if job.header is not None:
+        save_sphere_header(job.urdf, spheres, job.header)
+
+    if job.hierarchy is not None:
+        trees: dict[str, list[list[Spherization]]] = {}
+        for name, (helper_name, cache) in job.names.items():
+            trees.setdefault(name.split('::')[0], []).append(
+                sh.get_hierarchy(helper_name, job.depth, cache, job.target_count, job.target_error)
+                )
+
+        save_sphere_hierarchies({link: sphere_hierarchy(levels) for link, levels in trees.items()}, job.hierarchy)
+
+
+def write_urdfs(
+        sh: SpherizationHelper,
+        jobs: list[URDFSpherization],
+    ) -> Iterator[tuple[URDFSpherization, Exception | None]]:
+    # Writes each URDF as soon as the last spherization it depends on finishes, yielding it with the error that
+    # stopped it, if any, so one failing robot does not hold up the rest.
+    def write(job: URDFSpherization) -> tuple[URDFSpherization, Exception | None]:
+        try:
+            write_urdf(sh, job)
+        except Exception as e:
+            return job, e
+
+        return job, None
+
+    waiting = sh.ps.waiting.keys()
+    pending = [{sh.keys[name][0] for name, _ in job.names.values()} & waiting for job in jobs]
+
+    for job, keys in zip(jobs, pending):
+        if not keys:
+            yield write(job)
+
+    for key, _ in sh.ps.as_completed():
+        for job, keys in zip(jobs, pending):
+            if key in keys:
+                keys.discard(key)
+                if not keys:
+                    yield write(job)
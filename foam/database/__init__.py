@@ -0,0 +1,597 @@
+from abc import ABC, abstractmethod
+from collections.abc import Callable, Iterator
+from contextlib import contextmanager
+from json import load as jsload
+from json import loads as jsloads
+from json import dumps as jsdumps
+from os import replace as replace_file
+from functools import partial
+from pathlib import Path
+from sqlite3 import connect
+from threading import Lock
+
+import numpy as np
+
+from foam.model import *
+
+
+def _pack_spheres(spherization: Spherization) -> bytes:
+    return spherization.array.tobytes()
+
+
+def _unpack_spheres(payload: bytes) -> NDArray:
+    return np.frombuffer(payload, dtype = np.float64).reshape(-1, 4).copy()
+
+
+def _pack_parents(spherization: Spherization) -> bytes | None:
+    return None if spherization.parents is None else spherization.parents.astype(np.int64).tobytes()
+
+
+def _unpack_parents(payload: bytes | None) -> NDArray | None:
+    return None if payload is None else np.frombuffer(payload, dtype = np.int64).astype(int)
+
+
+class DatabaseBackend(ABC):
+
+    @abstractmethod
+    def get(self, key: str) -> list[Spherization] | None:
+        ...
+
+    @abstractmethod
+    def put(self, key: str, spherizations: list[Spherization]):
+        ...
+
+    def update(
+            self,
+            key: str,
+            merge: Callable[[list[Spherization] | None], list[Spherization]],
+        ) -> list[Spherization]:
+        # Replaces an entry with `merge` of what is stored, without another writer getting in between.
+        spherizations = merge(self.get(key))
+        self.put(key, spherizations)
+        return spherizations
+
+    @abstractmethod
+    def keys(self) -> list[str]:
+        ...
+
+    @abstractmethod
+    def get_verdict(self, key: str) -> str | None:
+        ...
+
+    @abstractmethod
+    def put_verdict(self, key: str, verdict: str):
+        ...
+
+    @abstractmethod
+    def get_front(self, key: str) -> list[SweepCandidate]:
+        ...
+
+    @abstractmethod
+    def put_front(self, key: str, candidates: list[SweepCandidate]):
+        ...
+
+    def update_front(
+            self,
+            key: str,
+            merge: Callable[[list[SweepCandidate]], list[SweepCandidate]],
+        ) -> list[SweepCandidate]:
+        # As `update`, for the sweep front of a mesh.
+        candidates = merge(self.get_front(key))
+        self.put_front(key, candidates)
+        return candidates
+
+    @abstractmethod
+    def fronts(self) -> list[str]:
+        ...
+
+    @abstractmethod
+    def get_bounds(self, key: str) -> tuple[float, float] | None:
+        ...
+
+    @abstractmethod
+    def put_bounds(self, key: str, bounds: tuple[float, float]):
+        ...
+
+    @abstractmethod
+    def all_bounds(self) -> dict[str, tuple[float, float]]:
+        ...
+
+    @abstractmethod
+    def legacy_entries(self) -> dict[str, dict[int, dict[int, Spherization]]]:
+        ...
+
+    @abstractmethod
+    def put_legacy(self, name: str, entry: dict[int, dict[int, Spherization]]):
+        ...
+
+    def close(self):
+        pass
+
+
+class JSONBackend(DatabaseBackend):
+    # The original single-file format. Everything is read up front and written back on close; the rewrite goes
+    # through a temporary file so a crash mid-write never corrupts the database.
+
+    VERDICTS = '__verdicts__'
+    FRONTS = '__fronts__'
+    BOUNDS = '__bounds__'
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.db = {}
+        self.legacy = {}
+        self.verdicts = {}
+        self.pareto = {}
+        self.bounds = {}
+
+        if path.exists():
+            with open(path, 'r') as json_file:
+                contents = jsload(json_file, cls = SphereDecoder)
+                self.verdicts = contents.pop(self.VERDICTS, {})
+                self.pareto = contents.pop(self.FRONTS, {})
+                self.bounds = {key: tuple(value) for key, value in contents.pop(self.BOUNDS, {}).items()}
+                for key, value in contents.items():
+                    if isinstance(value, list):
+                        self.db[key] = value
+                    else:
+                        self.legacy[key] = value
+
+    def get(self, key: str) -> list[Spherization] | None:
+        return self.db.get(key)
+
+    def put(self, key: str, spherizations: list[Spherization]):
+        self.db[key] = spherizations
+
+    def keys(self) -> list[str]:
+        return list(self.db.keys())
+
+    def get_verdict(self, key: str) -> str | None:
+        return self.verdicts.get(key)
+
+    def put_verdict(self, key: str, verdict: str):
+        self.verdicts[key] = verdict
+
+    def get_front(self, key: str) -> list[SweepCandidate]:
+        return self.pareto.get(key, [])
+
+    def put_front(self, key: str, candidates: list[SweepCandidate]):
+        self.pareto[key] = candidates
+
+    def fronts(self) -> list[str]:
+        return list(self.pareto.keys())
+
+    def get_bounds(self, key: str) -> tuple[float, float] | None:
+        return self.bounds.get(key)
+
+    def put_bounds(self, key: str, bounds: tuple[float, float]):
+        self.bounds[key] = bounds
+
+    def all_bounds(self) -> dict[str, tuple[float, float]]:
+        return dict(self.bounds)
+
+    def legacy_entries(self) -> dict[str, dict[int, dict[int, Spherization]]]:
+        # Entries from before spherizations were keyed by content, as mesh name -> branch -> depth.
+        return {
+            name: {int(branch): {int(depth): s for depth, s in levels.items()} for branch, levels in entry.items()}
+            for name, entry in self.legacy.items()
+            }
+
+    def put_legacy(self, name: str, entry: dict[int, dict[int, Spherization]]):
+        self.legacy[name] = entry
+
+    def close(self):
+        temporary = self.path.with_name(self.path.name + '.tmp')
+        with open(temporary, 'w') as f:
+            f.write(
+                jsdumps(
+                    self.legacy | self.db | {
+                        self.VERDICTS: self.verdicts,
+                        self.FRONTS: self.pareto,
+                        self.BOUNDS: self.bounds,
+                        },
+                    indent = 4,
+                    cls = SphereEncoder,
+                    )
+                )
+
+        replace_file(temporary, self.path)
+
+
+class SQLiteBackend(DatabaseBackend):
+    # Entries are loaded lazily per key and every write is its own transaction, so progress survives a killed
+    # process. WAL mode and a generous busy timeout let several processes share one database file.
+
+    def __init__(self, path: Path, timeout: float = 60.):
+        self.path = path
+        self.lock = Lock()
+        self.connection = connect(path, timeout = timeout, isolation_level = None, check_same_thread = False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute(
+            '''
+            CREATE TABLE IF NOT EXISTS spherizations (
+                key TEXT NOT NULL,
+                level INTEGER NOT NULL,
+                mean REAL NOT NULL,
+                best REAL NOT NULL,
+                worst REAL NOT NULL,
+                spheres BLOB NOT NULL,
+                method TEXT,
+                parents BLOB,
+                PRIMARY KEY (key, level)
+            )
+            '''
+            )
+        self._add_column('spherizations', 'method', 'TEXT')
+        self._add_column('spherizations', 'parents', 'BLOB')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS verdicts (key TEXT PRIMARY KEY, verdict TEXT NOT NULL)')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS bounds (key TEXT PRIMARY KEY, radius REAL NOT NULL, volume REAL NOT NULL)'
+            )
+        self.connection.execute(
+            '''
+            CREATE TABLE IF NOT EXISTS legacy (
+                name TEXT NOT NULL,
+                branch INTEGER NOT NULL,
+                depth INTEGER NOT NULL,
+                mean REAL NOT NULL,
+                best REAL NOT NULL,
+                worst REAL NOT NULL,
+                spheres BLOB NOT NULL,
+                PRIMARY KEY (name, branch, depth)
+            )
+            '''
+            )
+        self.connection.execute(
+            '''
+            CREATE TABLE IF NOT EXISTS fronts (
+                key TEXT NOT NULL,
+                candidate INTEGER NOT NULL,
+                parameters TEXT NOT NULL,
+                runtime REAL NOT NULL,
+                mean REAL NOT NULL,
+                best REAL NOT NULL,
+                worst REAL NOT NULL,
+                spheres BLOB NOT NULL,
+                PRIMARY KEY (key, candidate)
+            )
+            '''
+            )
+
+    def _add_column(self, table: str, column: str, declaration: str):
+        # Databases created before a column existed get it added in place, empty for the old rows.
+        columns = [row[1] for row in self.connection.execute(f'PRAGMA table_info({table})')]
+        if column not in columns:
+            self.connection.execute(f'ALTER TABLE {table} ADD COLUMN {column} {declaration}')
+
+    @contextmanager
+    def _transaction(self) -> Iterator[None]:
+        # Takes the write lock up front, so a read inside the transaction is still current when it writes.
+        self.connection.execute('BEGIN IMMEDIATE')
+        try:
+            yield
+        except BaseException:
+            self.connection.execute('ROLLBACK')
+            raise
+
+        self.connection.execute('COMMIT')
+
+    def _get(self, key: str) -> list[Spherization] | None:
+        rows = self.connection.execute(
+            'SELECT mean, best, worst, spheres, method, parents FROM spherizations WHERE key = ? ORDER BY level',
+            (key, ),
+            ).fetchall()
+
+        if not rows:
+            return None
+
+        return [
+            Spherization(_unpack_spheres(spheres), mean, best, worst, _unpack_parents(parents), method)
+            for mean, best, worst, spheres, method, parents in rows
+            ]
+
+    def _put(self, key: str, spherizations: list[Spherization]):
+        self.connection.executemany(
+            '''
+            INSERT OR REPLACE INTO spherizations (key, level, mean, best, worst, spheres, method, parents)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ''',
+            [
+                (
+                    key,
+                    level,
+                    s.mean_error,
+                    s.best_error,
+                    s.worst_error,
+                    _pack_spheres(s),
+                    s.method,
+                    _pack_parents(s),
+                    ) for level, s in enumerate(spherizations)
+                ],
+            )
+
+    def get(self, key: str) -> list[Spherization] | None:
+        with self.lock:
+            return self._get(key)
+
+    def put(self, key: str, spherizations: list[Spherization]):
+        # All levels land together or not at all.
+        with self.lock, self._transaction():
+            self._put(key, spherizations)
+
+    def update(
+            self,
+            key: str,
+            merge: Callable[[list[Spherization] | None], list[Spherization]],
+        ) -> list[Spherization]:
+        with self.lock, self._transaction():
+            spherizations = merge(self._get(key))
+            self._put(key, spherizations)
+
+        return spherizations
+
+    def keys(self) -> list[str]:
+        with self.lock:
+            return [key for key, in self.connection.execute('SELECT DISTINCT key FROM spherizations')]
+
+    def get_verdict(self, key: str) -> str | None:
+        with self.lock:
+            row = self.connection.execute('SELECT verdict FROM verdicts WHERE key = ?', (key, )).fetchone()
+
+        return row[0] if row else None
+
+    def put_verdict(self, key: str, verdict: str):
+        with self.lock:
+            self.connection.execute('INSERT OR REPLACE INTO verdicts VALUES (?, ?)', (key, verdict))
+
+    def _get_front(self, key: str) -> list[SweepCandidate]:
+        rows = self.connection.execute(
+            'SELECT parameters, runtime, mean, best, worst, spheres FROM fronts WHERE key = ? ORDER BY candidate',
+            (key, ),
+            ).fetchall()
+
+        return [
+            SweepCandidate(Spherization(_unpack_spheres(spheres), mean, best, worst), jsloads(parameters), runtime)
+            for parameters, runtime, mean, best, worst, spheres in rows
+            ]
+
+    def _put_front(self, key: str, candidates: list[SweepCandidate]):
+        self.connection.execute('DELETE FROM fronts WHERE key = ?', (key, ))
+        self.connection.executemany(
+            'INSERT INTO fronts VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            [
+                (
+                    key,
+                    i,
+                    jsdumps(c.parameters, sort_keys = True),
+                    c.runtime,
+                    c.spherization.mean_error,
+                    c.spherization.best_error,
+                    c.spherization.worst_error,
+                    _pack_spheres(c.spherization),
+                    ) for i, c in enumerate(candidates)
+                ],
+            )
+
+    def get_front(self, key: str) -> list[SweepCandidate]:
+        with self.lock:
+            return self._get_front(key)
+
+    def put_front(self, key: str, candidates: list[SweepCandidate]):
+        # The whole front is replaced at once, so readers never see a mix of old and new candidates.
+        with self.lock, self._transaction():
+            self._put_front(key, candidates)
+
+    def update_front(
+            self,
+            key: str,
+            merge: Callable[[list[SweepCandidate]], list[SweepCandidate]],
+        ) -> list[SweepCandidate]:
+        with self.lock, self._transaction():
+            candidates = merge(self._get_front(key))
+            self._put_front(key, candidates)
+
+        return candidates
+
+    def fronts(self) -> list[str]:
+        with self.lock:
+            return [key for key, in self.connection.execute('SELECT DISTINCT key FROM fronts')]
+
+    def get_bounds(self, key: str) -> tuple[float, float] | None:
+        with self.lock:
+            row = self.connection.execute('SELECT radius, volume FROM bounds WHERE key = ?', (key, )).fetchone()
+
+        return row
+
+    def put_bounds(self, key: str, bounds: tuple[float, float]):
+        with self.lock:
+            self.connection.execute('INSERT OR REPLACE INTO bounds VALUES (?, ?, ?)', (key, *bounds))
+
+    def all_bounds(self) -> dict[str, tuple[float, float]]:
+        with self.lock:
+            return {key: (radius, volume) for key, radius, volume in self.connection.execute('SELECT * FROM bounds')}
+
+    def legacy_entries(self) -> dict[str, dict[int, dict[int, Spherization]]]:
+        with self.lock:
+            rows = self.connection.execute('SELECT * FROM legacy ORDER BY name, branch, depth').fetchall()
+
+        entries = {}
+        for name, branch, depth, mean, best, worst, spheres in rows:
+            levels = entries.setdefault(name, {}).setdefault(branch, {})
+            levels[depth] = Spherization(_unpack_spheres(spheres), mean, best, worst)
+
+        return entries
+
+    def put_legacy(self, name: str, entry: dict[int, dict[int, Spherization]]):
+        with self.lock, self._transaction():
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO legacy VALUES (?, ?, ?, ?, ?, ?, ?)',
+                [
+                    (name, branch, depth, s.mean_error, s.best_error, s.worst_error, _pack_spheres(s))
+                    for branch, levels in entry.items()
+                    for depth, s in levels.items()
+                    ],
+                )
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+def pareto_front(candidates: list[SweepCandidate]) -> list[SweepCandidate]:
+    # Keeps the candidates no other candidate beats on sphere count, mean error and runtime at once, ordered by
+    # sphere count.
+    if not candidates:
+        return []
+
+    points = np.array([[len(c.spherization), c.spherization.mean_error, c.runtime] for c in candidates])
+    no_worse = (points[:, None, :] <= points[None, :, :]).all(axis = -1)
+    better = (points[:, None, :] < points[None, :, :]).any(axis = -1)
+    dominated = (no_worse & better).any(axis = 0)
+
+    front = [c for c, d in zip(candidates, dominated) if not d]
+    return sorted(front, key = lambda c: (len(c.spherization), c.spherization.mean_error))
+
+
+def select_candidate(
+        front: list[SweepCandidate],
+        target_count: int | None = None,
+        target_error: float | None = None,
+    ) -> SweepCandidate:
+    # With a sphere budget, the most accurate candidate within it; with an error target, the fewest spheres that
+    # meet it. Falls back to the closest candidate when none qualifies.
+    counts = np.array([len(c.spherization) for c in front])
+    errors = np.array([c.spherization.mean_error for c in front])
+
+    mask = np.ones(len(front), dtype = bool)
+    if target_count is not None:
+        mask &= counts <= target_count
+
+    if target_error is not None:
+        mask &= errors <= target_error
+
+    if not mask.any():
+        return front[int(np.argmin(counts if target_count is not None else errors))]
+
+    candidates = np.flatnonzero(mask)
+    if target_count is not None:
+        return front[candidates[np.lexsort((counts[candidates], errors[candidates]))[0]]]
+
+    return front[candidates[np.lexsort((errors[candidates], counts[candidates]))[0]]]
+
+
+def merge_spherizations(
+        spherizations: list[Spherization],
+        existing: list[Spherization] | None,
+    ) -> list[Spherization]:
+    # Levels are kept from whichever run did better. A level whose parent level came from the other run loses its
+    # parent links.
+    if existing is None:
+        return spherizations
+
+    merged = []
+    from_new = []
+    for new, old in zip(spherizations, existing):
+        level = new if new < old else old
+        from_new.append(level is new)
+        if len(from_new) > 1 and from_new[-1] != from_new[-2] and level.parents is not None:
+            level = level.copy()
+            level.parents = None
+
+        merged.append(level)
+
+    return merged
+
+
+def open_backend(path: Path) -> DatabaseBackend:
+    if path.suffix == '.json':
+        return JSONBackend(path)
+
+    return SQLiteBackend(path)
+
+
+class SpherizationDatabase:
+    # Entries are keyed by `spherization_key`, i.e., by the content of the prepared mesh and every parameter
+    # that went into spherizing it. The storage format is picked from the file suffix: `.json` keeps the original
+    # single-file format, anything else is an SQLite database.
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.backend = open_backend(path)
+        self.db = {}
+
+    def __del__(self):
+        self.backend.close()
+
+    def _load(self, key: str) -> list[Spherization] | None:
+        if key not in self.db:
+            spherizations = self.backend.get(key)
+            if spherizations is None:
+                return None
+
+            self.db[key] = spherizations
+
+        return self.db[key]
+
+    def add(self, key: str, spherizations: list[Spherization]):
+        # Merged with what is stored at the time of writing, which another process may have added meanwhile.
+        self.db[key] = self.backend.update(key, partial(merge_spherizations, spherizations))
+
+    def get(self, key: str) -> list[Spherization]:
+        spherizations = self._load(key)
+        if spherizations is None:
+            raise KeyError(key)
+
+        return spherizations
+
+    def exists(self, key: str) -> bool:
+        return self._load(key) is not None
+
+    def get_verdict(self, key: str) -> str | None:
+        return self.backend.get_verdict(key)
+
+    def set_verdict(self, key: str, verdict: str):
+        self.backend.put_verdict(key, verdict)
+
+    def get_front(self, key: str) -> list[SweepCandidate]:
+        return self.backend.get_front(key)
+
+    def get_bounds(self, mesh_digest: str) -> tuple[float, float] | None:
+        # Bounding sphere radius and volume of a mesh, keyed by its content like the spherizations themselves.
+        return self.backend.get_bounds(mesh_digest)
+
+    def set_bounds(self, mesh_digest: str, bounds: tuple[float, float]):
+        self.backend.put_bounds(mesh_digest, bounds)
+
+    def add_candidates(self, key: str, candidates: list[SweepCandidate]) -> list[SweepCandidate]:
+        # Merged with the stored front at the time of writing, as another sweep may be adding to it as well.
+        return self.backend.update_front(key, lambda front: pareto_front(front + candidates))
+
+
+def migrate_database(source: Path, destination: Path) -> int:
+    source_backend = JSONBackend(source)
+    destination_backend = open_backend(destination)
+
+    for key in source_backend.keys():
+        destination_backend.put(key, source_backend.db[key])
+
+    for key, verdict in source_backend.verdicts.items():
+        destination_backend.put_verdict(key, verdict)
+
+    for key in source_backend.fronts():
+        destination_backend.put_front(key, source_backend.get_front(key))
+
+    for key, bounds in source_backend.all_bounds().items():
+        destination_backend.put_bounds(key, bounds)
+
+    # Entries keyed by mesh name cannot be looked up by content, but are carried over rather than lost.
+    legacy = source_backend.legacy_entries()
+    for name, entry in legacy.items():
+        destination_backend.put_legacy(name, entry)
+
+    if legacy:
+        print(f"Carried over {len(legacy)} legacy entries keyed by mesh name")
+
+    destination_backend.close()
+    return len(source_backend.keys())
@@ -0,0 +1,178 @@
+from dataclasses import dataclass
+from itertools import chain
+
+from scipy.spatial import cKDTree
+from trimesh.base import Trimesh
+from trimesh.sample import sample_surface
+
+import numpy as np
+from numpy.typing import NDArray
+
+from foam.model import *
+
+
+@dataclass
+class SpherizationQuality:
+    surface_coverage: float    # Fraction of surface samples inside at least one sphere
+    volume_coverage: float     # Fraction of interior samples inside at least one sphere
+    excess_volume: float       # Volume inside the spheres but outside the mesh
+    hausdorff: float           # One-sided Hausdorff distance from the sphere surfaces to the mesh
+
+
+def covered(points: NDArray, spheres: NDArray, tree: cKDTree | None = None) -> NDArray:
+    # One ball query per sphere against a KD-tree of the points, rather than testing every point-sphere pair.
+    covered_mask = np.zeros(len(points), dtype = bool)
+    if len(points) == 0 or len(spheres) == 0:
+        return covered_mask
+
+    if tree is None:
+        tree = cKDTree(points)
+
+    hits = tree.query_ball_point(spheres[:, :3], spheres[:, 3], return_sorted = False)
+    covered_mask[np.fromiter(chain.from_iterable(hits), dtype = np.int64)] = True
+    return covered_mask
+
+
+def _sphere_surface_points(spheres: NDArray, per_sphere: int) -> NDArray:
+    i = np.arange(per_sphere) + 0.5
+    z = 1 - 2 * i / per_sphere
+    theta = np.pi * (1 + 5**0.5) * i
+    rho = np.sqrt(1 - z**2)
+    directions = np.stack([rho * np.cos(theta), rho * np.sin(theta), z], axis = 1)
+    return (spheres[:, None, :3] + spheres[:, None, 3:] * directions[None]).reshape(-1, 3)
+
+
+def one_sided_hausdorff(points: NDArray, surface: NDArray) -> float:
+    if len(points) == 0:
+        return 0.
+
+    distances, _ = cKDTree(surface).query(points)
+    return float(distances.max())
+
+
+def mesh_hausdorff(mesh: Trimesh, other: Trimesh, samples: int = 20000, seed: int = 0) -> float:
+    # Symmetric Hausdorff distance between two surfaces, estimated from surface samples of each.
+    points, _ = sample_surface(mesh, samples, seed = seed)
+    other_points, _ = sample_surface(other, samples, seed = seed)
+    return max(one_sided_hausdorff(points, other_points), one_sided_hausdorff(other_points, points))
+
+
+def evaluate_spherization(
+        mesh: Trimesh,
+        spherization: Spherization,
+        surface_samples: int = 100000,
+        volume_resolution: int = 64,
+        excess_samples: int = 200000,
+        sphere_samples: int = 64,
+        seed: int = 0,
+    ) -> SpherizationQuality:
+    spheres = spherization.array
+    rng = np.random.default_rng(seed)
+
+    surface, _ = sample_surface(mesh, surface_samples, seed = seed)
+    surface_coverage = covered(surface, spheres).mean()
+
+    # Inside/outside tests use a filled voxelization, which unlike ray tests needs no spatial index extras.
+    pitch = mesh.extents.max() / volume_resolution
+    voxels = mesh.voxelized(pitch).fill()
+    interior = voxels.points
+    volume_coverage = covered(interior, spheres).mean() if len(interior) else 0.
+
+    low = (spheres[:, :3] - spheres[:, 3:]).min(axis = 0)
+    high = (spheres[:, :3] + spheres[:, 3:]).max(axis = 0)
+    samples = rng.uniform(low, high, size = (excess_samples, 3))
+    outside = covered(samples, spheres) & ~voxels.is_filled(samples)
+    excess_volume = np.prod(high - low) * outside.mean()
+
+    # Only the parts of the sphere surfaces that lie outside the mesh contribute to the over-approximation.
+    boundary = _sphere_surface_points(spheres, sphere_samples)
+    boundary = boundary[~voxels.is_filled(boundary)]
+    hausdorff = one_sided_hausdorff(boundary, surface)
+
+    return SpherizationQuality(
+        float(surface_coverage),
+        float(volume_coverage),
+        float(excess_volume),
+        hausdorff,
+        )
+
+
+@dataclass
+class PruningReport:
+    removed: int       # Spheres dropped for lying inside another sphere
+    remaining: int
+    coverage: float    # Fraction of the original spheres' union volume still covered
+
+
+def contained_spheres(spheres: NDArray, tolerance: float = 0.) -> NDArray:
+    # Mask of the spheres that lie inside another sphere grown by `tolerance`. Candidate pairs come from one
+    # ball query per sphere; of spheres that contain each other, only the first is kept.
+    redundant = np.zeros(len(spheres), dtype = bool)
+    if len(spheres) < 2:
+        return redundant
+
+    centers, radii = spheres[:, :3], spheres[:, 3]
+    hits = cKDTree(centers).query_ball_point(centers, radii + tolerance, return_sorted = False)
+    outer = np.repeat(np.arange(len(spheres)), [len(h) for h in hits])
+    inner = np.fromiter(chain.from_iterable(hits), dtype = np.int64, count = len(outer))
+    pairs = outer != inner
+    outer, inner = outer[pairs], inner[pairs]
+
+    distance = np.linalg.norm(centers[outer] - centers[inner], axis = 1)
+    inside = distance + radii[inner] <= radii[outer] + tolerance
+    mutual = distance + radii[outer] <= radii[inner] + tolerance
+    redundant[inner[inside & (~mutual | (outer < inner))]] = True
+    return redundant
+
+
+def _union_samples(spheres: NDArray, per_sphere: int, rng: np.random.Generator) -> tuple[NDArray, NDArray]:
+    # Uniform samples inside every sphere, weighted by the sphere's volume over the number of spheres that
+    # contain the sample, so the weights of all samples add up to the volume of the union.
+    directions = rng.normal(size = (len(spheres), per_sphere, 3))
+    directions /= np.linalg.norm(directions, axis = -1, keepdims = True)
+    lengths = spheres[:, None, 3:] * rng.uniform(size = (len(spheres), per_sphere, 1))**(1. / 3.)
+    points = (spheres[:, None, :3] + directions * lengths).reshape(-1, 3)
+
+    hits = cKDTree(points).query_ball_point(spheres[:, :3], spheres[:, 3], return_sorted = False)
+    containing = np.bincount(np.fromiter(chain.from_iterable(hits), dtype = np.int64), minlength = len(points))
+    volumes = 4. / 3. * np.pi * spheres[:, 3]**3 / per_sphere
+    return points, np.repeat(volumes, per_sphere) / np.maximum(containing, 1)
+
+
+def prune_spheres(
+        spheres: NDArray,
+        tolerance: float = 0.,
+        samples: int = 64,
+        seed: int = 0,
+    ) -> tuple[NDArray, PruningReport]:
+    # Mask of the spheres to keep. With a tolerance, removed spheres may poke out of the ones that remain, and
+    # the report's coverage says how much of the original volume that gives up.
+    redundant = contained_spheres(spheres, tolerance)
+    coverage = 1.
+    if tolerance > 0. and redundant.any():
+        points, weights = _union_samples(spheres, samples, np.random.default_rng(seed))
+        lost = ~covered(points, spheres[~redundant])
+        coverage = 1. - weights[lost].sum() / weights.sum()
+
+    return ~redundant, PruningReport(int(redundant.sum()), int((~redundant).sum()), float(coverage))
+
+
+def prune_link_spheres(
+        spheres: dict[str, Spherization],
+        tolerance: float = 0.,
+    ) -> tuple[dict[str, Spherization], dict[str, PruningReport]]:
+    # Prunes the spheres of all collisions of a link together, as they end up in the same link of the URDF.
+    # Collisions are keyed `link::collision`, as for `set_urdf_spheres`.
+    links: dict[str, list[str]] = {}
+    for name in spheres:
+        links.setdefault(name.split('::')[0], []).append(name)
+
+    pruned = {}
+    reports = {}
+    for link, names in links.items():
+        keep, reports[link] = prune_spheres(np.concatenate([spheres[name].array for name in names]), tolerance)
+        bounds = np.cumsum([0] + [len(spheres[name]) for name in names])
+        for name, start, end in zip(names, bounds, bounds[1:]):
+            pruned[name] = spheres[name].filter(keep[start:end])
+
+    return pruned, reports
@@ -1,13 +1,20 @@
-from sys import stdout
+from collections.abc import Iterator
+from contextlib import contextmanager
 from pathlib import Path
-from os import remove as remove_file
-from subprocess import run, DEVNULL
+from os import killpg
+from signal import SIGINT, SIGKILL, SIGTERM
+from asyncio import create_subprocess_exec, ensure_future
+from asyncio import run as async_run
+from asyncio import wait as async_wait
+from asyncio.subprocess import PIPE
+from subprocess import CompletedProcess, DEVNULL
+from time import monotonic
 
-from trimesh.exchange.obj import export_obj
 from trimesh.base import Trimesh
 
 from foam.model import *
 from foam.utility import *
+from foam.tracing import *
 
 EXTERNAL_BINARY_DIR = Path(__file__).parent
 MAKE_TREE_MEDIAL_PATH = EXTERNAL_BINARY_DIR / "makeTreeMedial"
@@ -21,57 +28,227 @@ MANIFOLD_OLD_PATH = EXTERNAL_BINARY_DIR / "manifold_old"
 SIMPLIFY_OLD_PATH = EXTERNAL_BINARY_DIR / "simplify_old"
 
 
+class MissingBinaryError(Exception):
+    pass
+
+
+class ExternalTimeoutError(Exception):
+    pass
+
+
+class ExternalCancelledError(Exception):
+    pass
+
+
+class ExternalFailureError(RuntimeError):
+    # The binary ran to completion and rejected its input. Unlike timeouts, cancellation or I/O errors this says
+    # something about the mesh, so it is the only failure worth remembering.
+    pass
+
+
+class IncompleteTreeError(Exception):
+    # The binary ran, but its tree lacks levels the job asked for. That depends on the depth and branch as much as
+    # on the mesh, so unlike `ExternalFailureError` it says nothing about the mesh as a whole.
+    pass
+
+
+# Signals that mean something else stopped the binary, e.g. the out of memory killer, rather than the binary
+# giving up on its input.
+EXTERNAL_KILL_SIGNALS = (SIGINT, SIGKILL, SIGTERM)
+
+
+def check_external(process: CompletedProcess, output: Path | None = None):
+    name = Path(process.args[0]).name
+    if process.returncode < 0 and -process.returncode in EXTERNAL_KILL_SIGNALS:
+        raise RuntimeError(f"{name} was killed by signal {-process.returncode}")
+
+    if process.returncode != 0:
+        raise ExternalFailureError(f"{name} failed with return code {process.returncode}. {process.stdout or ''}")
+
+    if output is not None and (not output.exists() or output.stat().st_size == 0):
+        raise ExternalFailureError(f"{name} did not write {output.name}")
+
+
+# How often a running binary checks for its deadline and for cancellation.
+POLL_INTERVAL = 0.1
+
+# Number of external binaries launched by this process, for benchmarking.
+EXTERNAL_RUNS = 0
+
+# Set through `set_cancel_event`, e.g. as a pool initializer, so binaries already running in a worker can be
+# stopped from the process that owns the pool.
+CANCEL_EVENT = None
+
+
+def set_cancel_event(event):
+    global CANCEL_EVENT
+    CANCEL_EVENT = event
+
+
+async def run_external_async(
+        command: list[str],
+        timeout: float | None = None,
+        capture_output: bool = False,
+        stdout = None,
+    ) -> CompletedProcess:
+    # A missing binary is a build problem, not a property of the mesh, so it must not look like a failed run.
+    if not Path(command[0]).exists():
+        raise MissingBinaryError(f"External binary {command[0]} not found, has foam been built?")
+
+    global EXTERNAL_RUNS
+    EXTERNAL_RUNS += 1
+
+    with span(Path(command[0]).name) as stage:
+        process = await _run_process(command, timeout, capture_output, stdout)
+        stage.set(returncode = process.returncode)
+
+    return process
+
+
+async def _run_process(
+        command: list[str],
+        timeout: float | None,
+        capture_output: bool,
+        stdout,
+    ) -> CompletedProcess:
+    process = await create_subprocess_exec(
+        *command,
+        stdout = PIPE if capture_output else stdout,
+        stderr = PIPE if capture_output else None,
+        start_new_session = True,
+        )
+    communicate = ensure_future(process.communicate())
+    start = monotonic()
+
+    try:
+        while not communicate.done():
+            wait_time = POLL_INTERVAL
+            if timeout is not None:
+                remaining = timeout - (monotonic() - start)
+                if remaining <= 0:
+                    raise ExternalTimeoutError(f"{Path(command[0]).name} exceeded its {timeout:.1f}s deadline")
+
+                wait_time = min(wait_time, remaining)
+
+            if CANCEL_EVENT is not None and CANCEL_EVENT.is_set():
+                raise ExternalCancelledError(f"{Path(command[0]).name} was cancelled")
+
+            await async_wait({communicate}, timeout = wait_time)
+
+    except BaseException:
+        # The binary runs in its own process group so anything it spawned goes down with it.
+        if process.returncode is None:
+            killpg(process.pid, SIGKILL)
+
+        await communicate
+        raise
+
+    output, error = communicate.result()
+    return CompletedProcess(command, process.returncode, output, error) # type: ignore
+
+
+def run_external(command: list[str], timeout: float | None = None, **kwargs) -> CompletedProcess:
+    return async_run(run_external_async(command, timeout, **kwargs))
+
+
 def read_spherization_file(filename: Path, offset: NDArray) -> list[Spherization]:
-    output = []
+    # `saveSphereTree` writes a `levels degree` header and then every slot of the full tree breadth first, level
+    # `l` having `degree**l` slots, with empty slots at zero radius. Options and, for the methods that evaluate
+    # their trees, a per-level `Num`/`Worst`/`Best`/`Mean` block follow.
     with open(filename, 'r') as output_spheres:
-        lines = output_spheres.readlines()
-        spheres_per_level = [int(line.split(':')[1]) for line in lines if 'Num' in line]
-        best_error = [float(line.split(':')[1]) for line in lines if 'Best' in line]
-        worst_error = [float(line.split(':')[1]) for line in lines if 'Worst' in line]
-        mean_error = [float(line.split(':')[1]) for line in lines if 'Mean' in line]
-
-        for i, (level, mean, best, worst) in enumerate(zip(spheres_per_level,
-                                                           mean_error,
-                                                           best_error,
-                                                           worst_error,
-                                                           strict = True)):
-            start = 1 + sum(spheres_per_level[:i])
-            spheres = [
-                Sphere(*list(map(float, line.split()))[:-1], offset) # type: ignore
-                for line in lines[start:start + level]
-                ]
-
-            spheres = list(filter(lambda s: s.radius > 0, spheres))
-            output.append(Spherization(spheres, mean, best, worst))
+        levels, degree = map(int, output_spheres.readline().split()[:2])
+        counts = [degree**level for level in range(levels)]
+
+        rows = []
+        while len(rows) < sum(counts):
+            line = output_spheres.readline()
+            if not line:
+                raise ValueError(f"{filename} ends after {len(rows)} of {sum(counts)} spheres")
+
+            if line.strip():
+                rows.append(line.split()[:4])
+
+        stats = {'Worst': [], 'Best': [], 'Mean': []}
+        for line in output_spheres:
+            label, _, value = line.partition(':')
+            if label.strip() in stats:
+                stats[label.strip()].append(float(value))
+
+    spheres = np.array(rows, dtype = np.float64).reshape(-1, 4)
+    spheres[:, :3] += offset
+
+    # Octree and Hubbard trees are not evaluated, so their error is unknown.
+    unknown = [float('inf')] * levels
+    errors = [values if len(values) == levels else unknown for values in stats.values()]
+
+    # Parents are worked out on the full slots, then remapped onto the spheres that remain.
+    bounds = np.concatenate([[0], np.cumsum(counts)])
+    output = []
+    previous_index = None
+    for i, (worst, best, mean) in enumerate(zip(*errors)):
+        level = spheres[bounds[i]:bounds[i + 1]]
+        keep = level[:, 3] > 0
+
+        parents = np.full(counts[i], -1)
+        if previous_index is not None:
+            parents = previous_index[np.arange(counts[i]) // degree]
+
+        output.append(Spherization(level[keep], mean, best, worst, parents[keep]))
+        previous_index = np.where(keep, np.cumsum(keep) - 1, -1)
 
     return output
 
 
-def compute_spheres_helper(mesh: Trimesh, command: list[str],method) -> list[Spherization]:
+@contextmanager
+def _mesh_file(mesh: Trimesh | MeshFile, normals: bool = True) -> Iterator[MeshFile]:
+    if isinstance(mesh, MeshFile):
+        yield mesh
+    else:
+        with MeshFile(mesh, normals) as mesh_file:
+            yield mesh_file
+
+
+async def compute_spheres_helper_async(
+        mesh: Trimesh | MeshFile,
+        command: list[str],
+        method,
+        timeout: float | None = None,
+    ) -> list[Spherization]:
     # print(command)
     # print("flag 5")
-    _ = mesh.vertex_normals    # Need to compute vertex normals
-    with tempmesh() as (input_mesh, input_path):
-        input_mesh.write(export_obj(mesh))
-        input_mesh.flush()
-
+    with _mesh_file(mesh) as input_mesh:
+        input_path = input_mesh.path
         output_file = input_path.parent / (input_path.stem + f'-{method}.sph')
         # print(command)
-        sphere_output = run(command + [str(input_path)], capture_output=True)
+        try:
+            sphere_output = await run_external_async(command + [str(input_path)], timeout, capture_output=True)
+            low_bounds, high_bounds = input_mesh.load().bounds
 
-    if sphere_output.returncode != 0:
-        raise RuntimeError(f"Failed to create spheres for mesh. Mesh is probably invalid. {sphere_output.stdout}")
+            check_external(sphere_output)
 
-    low_bounds, high_bounds = mesh.bounds
-    offset = (high_bounds + low_bounds) / 2
+            offset = (high_bounds + low_bounds) / 2
 
-    spheres = read_spherization_file(output_file, offset)
-    remove_file(output_file)
+            with span('parse') as stage:
+                spheres = read_spherization_file(output_file, offset)
+                stage.set(spheres = [len(level) for level in spheres])
+
+        # Failed, timed out and cancelled runs can leave a partial tree behind as well.
+        finally:
+            output_file.unlink(missing_ok = True)
 
     return spheres
 
 
-def check_valid_for_spherization(method, mesh: Trimesh) -> bool:
+def compute_spheres_helper(
+        mesh: Trimesh | MeshFile,
+        command: list[str],
+        method,
+        timeout: float | None = None,
+    ) -> list[Spherization]:
+    return async_run(compute_spheres_helper_async(mesh, command, method, timeout))
+
+
+def check_valid_for_spherization(method, mesh: Trimesh | MeshFile) -> bool:
     MAKE_TREE_PATH = None
     if method == "grid":
         MAKE_TREE_PATH = MAKE_TREE_GRID_PATH
@@ -92,8 +269,7 @@ def check_valid_for_spherization(method, mesh: Trimesh) -> bool:
         return False
 
 
-def compute_spheres(
-        mesh: Trimesh,
+def make_tree_command(
         depth: int = 1,
         branch: int = 8,
         method: str = "medial",  # Can be 'medial', 'grid', 'spawn', 'octree', or 'hubbard'
@@ -113,7 +289,7 @@ def compute_spheres(
 
         num_samples: int = 500,  # Number of sample points for Hubbard's method (for 'hubbard' method)
         min_samples: int = 1  # Minimum number of sample points per triangle (for 'hubbard' method)
-    ) -> list[Spherization]:
+    ) -> list[str]:
 
     MAKE_TREE_PATH = None
     if method == "grid":
@@ -222,79 +398,170 @@ def compute_spheres(
     # if optimize:
     #     command.extend(['-optimise', 'simplex'])
 
-    return compute_spheres_helper(mesh, command, method)
-
-def simplify(mesh: Trimesh, ratio: float = 0.5, aggressiveness: float = 7.0) -> Trimesh:
-    with tempmesh() as (input_mesh, input_path):
-        input_mesh.write(export_obj(mesh))
-        input_mesh.flush()
-
-        with tempmesh() as (_, output_path):
-            run(
-                [
-                    str(SIMPLIFY_PATH),
-                    str(input_path),
-                    str(output_path),
-                    str(ratio),
-                    str(aggressiveness),
-                    ],
-                stdout = DEVNULL
-                )
-
-            return load_mesh_file(output_path)
-
-
-def simplify_manifold(mesh: Trimesh, ratio: float = 0.5) -> Trimesh:
-    with tempmesh() as (input_mesh, input_path):
-        input_mesh.write(export_obj(mesh))
-        input_mesh.flush()
-
-        with tempmesh() as (_, output_path):
-            run(
-                [
-                    str(SIMPLIFY_OLD_PATH),
-                    '-i',
-                    str(input_path),
-                    '-o',
-                    str(output_path),
-                    '-r',
-                    str(ratio),
-                    ],
-                stdout = DEVNULL
-                )
-
-            return load_mesh_file(output_path)
-
-
-def manifold(mesh: Trimesh, leaves: int = 1000) -> Trimesh:
-    _ = mesh.vertex_normals    # Need to compute vertex normals
-    with tempmesh() as (input_mesh, input_path):
-        input_mesh.write(export_obj(mesh))
-        input_mesh.flush()
-
-        with tempmesh() as (_, output_path):
-            run([str(MANIFOLD_OLD_PATH), str(input_path), str(output_path), str(leaves)], stdout = DEVNULL)
-            return load_mesh_file(output_path)
-
-
-def manifold_plus(mesh: Trimesh, depth: int = 8) -> Trimesh:
-    _ = mesh.vertex_normals    # Need to compute vertex normals
-    with tempmesh() as (input_mesh, input_path):
-        input_mesh.write(export_obj(mesh))
-        input_mesh.flush()
-
-        with tempmesh() as (_, output_path):
-            run(
-                [
-                    str(MANIFOLD_OLD_PATH),
-                    '--input',
-                    str(input_path),
-                    '--output',
-                    str(output_path),
-                    '--depth',
-                    str(depth)
-                    ],
-                stdout = DEVNULL
-                )
-
-            return load_mesh_file(output_path)
+    return command
+
+
+async def compute_spheres_async(
+        mesh: Trimesh | MeshFile,
+        timeout: float | None = None,
+        **spherization_kwargs,
+    ) -> list[Spherization]:
+    command = make_tree_command(**spherization_kwargs)
+    levels = await compute_spheres_helper_async(mesh, command, spherization_kwargs.get('method', 'medial'), timeout)
+
+    # A tree without every level asked for, or with an empty one, is as good as no tree at all.
+    depth = spherization_kwargs.get('depth', 1)
+    if len(levels) < depth + 1 or not all(levels):
+        raise IncompleteTreeError(f"{Path(command[0]).name} returned {len(levels)} of {depth + 1} levels")
+
+    return levels
+
+
+def compute_spheres(
+        mesh: Trimesh | MeshFile,
+        timeout: float | None = None,
+        **spherization_kwargs,
+    ) -> list[Spherization]:
+    return async_run(compute_spheres_async(mesh, timeout, **spherization_kwargs))
+
+async def simplify_async(
+        mesh: Trimesh | MeshFile,
+        ratio: float = 0.5,
+        aggressiveness: float = 7.0,
+        load: bool = True,
+        timeout: float | None = None,
+    ) -> Trimesh | MeshFile:
+    with _mesh_file(mesh, normals = False) as input_mesh:
+        output = MeshFile()
+        process = await run_external_async(
+            [
+                str(SIMPLIFY_PATH),
+                str(input_mesh.path),
+                str(output.path),
+                str(ratio),
+                str(aggressiveness),
+                ],
+            timeout,
+            stdout = DEVNULL
+            )
+
+    return _output(process, output, load)
+
+
+def simplify(
+        mesh: Trimesh | MeshFile,
+        ratio: float = 0.5,
+        aggressiveness: float = 7.0,
+        load: bool = True,
+        timeout: float | None = None,
+    ) -> Trimesh | MeshFile:
+    return async_run(simplify_async(mesh, ratio, aggressiveness, load, timeout))
+
+
+async def simplify_manifold_async(
+        mesh: Trimesh | MeshFile,
+        ratio: float = 0.5,
+        load: bool = True,
+        timeout: float | None = None,
+    ) -> Trimesh | MeshFile:
+    with _mesh_file(mesh, normals = False) as input_mesh:
+        output = MeshFile()
+        process = await run_external_async(
+            [
+                str(SIMPLIFY_OLD_PATH),
+                '-i',
+                str(input_mesh.path),
+                '-o',
+                str(output.path),
+                '-r',
+                str(ratio),
+                ],
+            timeout,
+            stdout = DEVNULL
+            )
+
+    return _output(process, output, load)
+
+
+def simplify_manifold(
+        mesh: Trimesh | MeshFile,
+        ratio: float = 0.5,
+        load: bool = True,
+        timeout: float | None = None,
+    ) -> Trimesh | MeshFile:
+    return async_run(simplify_manifold_async(mesh, ratio, load, timeout))
+
+
+async def manifold_async(
+        mesh: Trimesh | MeshFile,
+        leaves: int = 1000,
+        load: bool = True,
+        timeout: float | None = None,
+    ) -> Trimesh | MeshFile:
+    with _mesh_file(mesh) as input_mesh:
+        output = MeshFile()
+        process = await run_external_async(
+            [str(MANIFOLD_OLD_PATH), str(input_mesh.path), str(output.path), str(leaves)],
+            timeout,
+            stdout = DEVNULL,
+            )
+
+    return _output(process, output, load)
+
+
+def manifold(
+        mesh: Trimesh | MeshFile,
+        leaves: int = 1000,
+        load: bool = True,
+        timeout: float | None = None,
+    ) -> Trimesh | MeshFile:
+    return async_run(manifold_async(mesh, leaves, load, timeout))
+
+
+async def manifold_plus_async(
+        mesh: Trimesh | MeshFile,
+        depth: int = 8,
+        load: bool = True,
+        timeout: float | None = None,
+    ) -> Trimesh | MeshFile:
+    with _mesh_file(mesh) as input_mesh:
+        output = MeshFile()
+        process = await run_external_async(
+            [
+                str(MANIFOLD_OLD_PATH),
+                '--input',
+                str(input_mesh.path),
+                '--output',
+                str(output.path),
+                '--depth',
+                str(depth)
+                ],
+            timeout,
+            stdout = DEVNULL
+            )
+
+    return _output(process, output, load)
+
+
+def manifold_plus(
+        mesh: Trimesh | MeshFile,
+        depth: int = 8,
+        load: bool = True,
+        timeout: float | None = None,
+    ) -> Trimesh | MeshFile:
+    return async_run(manifold_plus_async(mesh, depth, load, timeout))
+
+
+def _output(process: CompletedProcess, output: MeshFile, load: bool) -> Trimesh | MeshFile:
+    try:
+        check_external(process, output.path)
+    except RuntimeError:
+        output.close()
+        raise
+
+    # Stages can hand their output file straight to the next stage instead of parsing and re-exporting it.
+    if not load:
+        return output
+
+    with output:
+        return output.load()
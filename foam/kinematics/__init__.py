@@ -0,0 +1,181 @@
+import numpy as np
+from numpy.typing import NDArray
+
+from trimesh.transformations import compose_matrix
+
+from foam.utility import *
+
+FIXED = 0
+REVOLUTE = 1
+PRISMATIC = 2
+
+JOINT_TYPES = {'fixed': FIXED, 'revolute': REVOLUTE, 'continuous': REVOLUTE, 'prismatic': PRISMATIC}
+
+
+def _as_list(value) -> list:
+    if value is None:
+        return []
+
+    return value if isinstance(value, list) else [value]
+
+
+def _vector(element: dict | None, attribute: str, default: list[float]) -> NDArray:
+    if element is None or f'@{attribute}' not in element:
+        return np.array(default, dtype = np.float64)
+
+    return np.fromiter(map(float, element[f'@{attribute}'].split()), dtype = np.float64)
+
+
+class SphereKinematics:
+    # The joint tree of a URDF flattened into arrays once, so world-frame spheres for a whole batch of
+    # configurations come out of one pass over the links, with every step vectorized over the batch. Buffers are
+    # reused between calls: results are overwritten by the next call, and an instance must not be shared between
+    # threads.
+
+    def __init__(self, urdf: URDFDict):
+        links = [link['@name'] for link in _as_list(urdf['robot'].get('link'))]
+        joints = _as_list(urdf['robot'].get('joint'))
+
+        by_child = {joint['child']['@link']: joint for joint in joints}
+        roots = [link for link in links if link not in by_child]
+        if len(roots) != 1:
+            raise ValueError(f"Expected a single root link, found {roots}")
+
+        children: dict[str, list[str]] = {}
+        for joint in joints:
+            children.setdefault(joint['parent']['@link'], []).append(joint['child']['@link'])
+
+        # Parents always come before their children.
+        order = roots
+        for link in order:
+            order.extend(children.get(link, []))
+
+        self.links = order
+        index = {link: i for i, link in enumerate(order)}
+
+        for joint in joints:
+            if joint['@type'] not in JOINT_TYPES:
+                raise ValueError(f"Joint {joint['@name']} has unsupported type {joint['@type']}")
+
+        # Configuration vectors hold the actuated joints in URDF order; mimic joints follow the joint they copy.
+        self.joint_names = [
+            joint['@name'] for joint in joints if JOINT_TYPES[joint['@type']] != FIXED and 'mimic' not in joint
+            ]
+        joint_index = {name: i for i, name in enumerate(self.joint_names)}
+
+        n = len(order)
+        self.parents = np.full(n, -1)
+        self.types = np.zeros(n, dtype = int)
+        self.origins = np.tile(np.eye(4), (n, 1, 1))
+        self.axes = np.zeros((n, 3))
+        self.variables = np.full(n, -1)
+        self.multipliers = np.ones(n)
+        self.offsets = np.zeros(n)
+
+        for link in order[1:]:
+            joint = by_child[link]
+            i = index[link]
+            origin = joint.get('origin')
+            self.parents[i] = index[joint['parent']['@link']]
+            self.types[i] = JOINT_TYPES[joint['@type']]
+            self.origins[i] = compose_matrix(
+                angles = _vector(origin, 'rpy', [0., 0., 0.]),
+                translate = _vector(origin, 'xyz', [0., 0., 0.]),
+                )
+
+            if self.types[i] != FIXED:
+                axis = _vector(joint.get('axis'), 'xyz', [1., 0., 0.])
+                self.axes[i] = axis / np.linalg.norm(axis)
+
+                mimic = joint.get('mimic')
+                if mimic is None:
+                    self.variables[i] = joint_index[joint['@name']]
+                else:
+                    self.variables[i] = joint_index[mimic['@joint']]
+                    self.multipliers[i] = float(mimic.get('@multiplier', 1.))
+                    self.offsets[i] = float(mimic.get('@offset', 0.))
+
+        # Cross-product matrices of the axes, for Rodrigues' rotation formula.
+        x, y, z = self.axes.T
+        zero = np.zeros(n)
+        self.cross = np.stack([zero, -z, y, z, zero, -x, -y, x, zero], axis = -1).reshape(n, 3, 3)
+        self.cross_squared = self.cross @ self.cross
+
+        # Sphere collisions are grouped by link so each link's spheres are one contiguous slice. A sphere's origin
+        # is its center; the collision's rpy only spins it in place.
+        spheres = [[] for _ in order]
+        for link in _as_list(urdf['robot'].get('link')):
+            for collision in _as_list(link.get('collision')):
+                if 'sphere' in collision['geometry']:
+                    center = _vector(collision.get('origin'), 'xyz', [0., 0., 0.])
+                    radius = float(collision['geometry']['sphere']['@radius'])
+                    spheres[index[link['@name']]].append([*center, radius])
+
+        self.spheres = np.array([sphere for link in spheres for sphere in link], dtype = np.float64).reshape(-1, 4)
+        self.sphere_links = np.repeat(np.arange(n), [len(link) for link in spheres])
+        bounds = np.concatenate([[0], np.cumsum([len(link) for link in spheres])])
+        self.slices = [(i, bounds[i], bounds[i + 1]) for i in range(n) if bounds[i + 1] > bounds[i]]
+
+        self.capacity = 0
+
+    def _allocate(self, batch: int):
+        if batch <= self.capacity:
+            return
+
+        self.capacity = batch
+        self.poses = np.empty((batch, len(self.links), 4, 4))
+        self.motion = np.tile(np.eye(4), (batch, 1, 1))
+        self.scratch = np.empty((batch, 4, 4))
+        self.rotation = np.empty((batch, 3, 3))
+        self.world = np.empty((batch, len(self.spheres), 4))
+        self.world[..., 3] = self.spheres[:, 3]
+
+    def link_poses(self, configurations: NDArray, base: NDArray | None = None) -> NDArray:
+        # (B, L, 4, 4) world poses of `self.links` for (B, J) configurations ordered as `self.joint_names`.
+        configurations = np.atleast_2d(np.asarray(configurations, dtype = np.float64))
+        batch = len(configurations)
+        self._allocate(batch)
+
+        poses = self.poses[:batch]
+        motion = self.motion[:batch]
+        scratch = self.scratch[:batch]
+        rotation = self.rotation[:batch]
+
+        poses[:, 0] = np.eye(4) if base is None else base
+        for i in range(1, len(self.links)):
+            parent = poses[:, self.parents[i]]
+            if self.types[i] == FIXED:
+                np.matmul(parent, self.origins[i], out = poses[:, i])
+                continue
+
+            values = configurations[:, self.variables[i]] * self.multipliers[i] + self.offsets[i]
+            if self.types[i] == REVOLUTE:
+                np.multiply(np.sin(values)[:, None, None], self.cross[i], out = rotation)
+                rotation += np.eye(3)
+                rotation += (1. - np.cos(values))[:, None, None] * self.cross_squared[i]
+                motion[:, :3, :3] = rotation
+                motion[:, :3, 3] = 0.
+            else:
+                motion[:, :3, :3] = np.eye(3)
+                np.multiply(values[:, None], self.axes[i], out = motion[:, :3, 3])
+
+            np.matmul(parent, self.origins[i], out = scratch)
+            np.matmul(scratch, motion, out = poses[:, i])
+
+        return poses
+
+    def world_spheres(self, configurations: NDArray, base: NDArray | None = None) -> NDArray:
+        # (B, S, 4) world-frame centers and radii of every sphere, in `sphere_links` order.
+        poses = self.link_poses(configurations, base)
+        batch = len(poses)
+        world = self.world[:batch]
+
+        for link, start, end in self.slices:
+            np.matmul(
+                self.spheres[start:end, :3],
+                poses[:, link, :3, :3].transpose(0, 2, 1),
+                out = world[:, start:end, :3],
+                )
+            world[:, start:end, :3] += poses[:, link, None, :3, 3]
+
+        return world
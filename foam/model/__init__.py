@@ -1,57 +1,241 @@
+from collections.abc import Sequence
 from dataclasses import dataclass
 from json import JSONEncoder, JSONDecoder
+from pathlib import Path
+from typing import Any
 
 import numpy as np
 from numpy.typing import NDArray
 
 
-@dataclass(slots = True)
 class Sphere:
-    origin: NDArray
-    radius: float
+    # Lightweight view onto one `[x, y, z, r]` row, kept for code that works sphere-by-sphere. Spheres created
+    # through `Spherization.spheres` share memory with the spherization's array.
+    __slots__ = ('data', )
 
     def __init__(self, x: float, y: float, z: float, r: float, offset: NDArray | None = None):
-        self.origin = np.array([x, y, z])
+        self.data = np.array([x, y, z, r], dtype = np.float64)
         if offset is not None:
-            self.origin += offset
+            self.data[:3] += offset
+
+    @classmethod
+    def view(cls, data: NDArray) -> 'Sphere':
+        sphere = cls.__new__(cls)
+        sphere.data = data
+        return sphere
+
+    @property
+    def origin(self) -> NDArray:
+        return self.data[:3]
 
-        self.radius = r
+    @property
+    def radius(self) -> float:
+        return float(self.data[3])
 
     def offset(self, offset: NDArray):
-        self.origin += offset
+        self.data[:3] += offset
 
+    def __repr__(self) -> str:
+        return f"Sphere(origin={self.origin!r}, radius={self.radius})"
 
-@dataclass(slots = True)
+
+@dataclass(slots = True, init = False, eq = False)
 class Spherization:
-    spheres: list[Sphere]
+    array: NDArray    # (N, 4) contiguous array of sphere centers and radii
     mean_error: float
     best_error: float
     worst_error: float
+    parents: NDArray | None    # Index of each sphere's parent in the previous level of the tree, -1 at the root
+    method: str | None         # Method that produced the spheres, which can differ from the one asked for
+
+    def __init__(
+            self,
+            spheres: NDArray | Sequence[Sphere],
+            mean_error: float,
+            best_error: float,
+            worst_error: float,
+            parents: NDArray | None = None,
+            method: str | None = None,
+        ):
+        if isinstance(spheres, np.ndarray):
+            self.array = np.ascontiguousarray(spheres, dtype = np.float64).reshape(-1, 4)
+        else:
+            self.array = np.array([sphere.data for sphere in spheres], dtype = np.float64).reshape(-1, 4)
+
+        self.mean_error = mean_error
+        self.best_error = best_error
+        self.worst_error = worst_error
+        self.parents = parents
+        self.method = method
+
+    @property
+    def spheres(self) -> list[Sphere]:
+        return [Sphere.view(row) for row in self.array]
+
+    @property
+    def centers(self) -> NDArray:
+        return self.array[:, :3]
+
+    @property
+    def radii(self) -> NDArray:
+        return self.array[:, 3]
 
     def __len__(self) -> int:
-        return len(self.spheres)
+        return len(self.array)
 
     def __lt__(self, other) -> bool:
         return self.mean_error < other.mean_error and self.best_error < other.best_error and self.worst_error < other.worst_error
 
+    def copy(self) -> 'Spherization':
+        return Spherization(
+            self.array.copy(),
+            self.mean_error,
+            self.best_error,
+            self.worst_error,
+            None if self.parents is None else self.parents.copy(),
+            self.method,
+            )
+
     def offset(self, offset: NDArray):
-        for sphere in self.spheres:
-            sphere.offset(offset)
+        self.array[:, :3] += offset
+
+    def transform(self, matrix: NDArray):
+        # Only similarity transforms map spheres to spheres; radii are scaled by the uniform scale factor.
+        self.array[:, :3] = self.array[:, :3] @ matrix[:3, :3].T + matrix[:3, 3]
+        self.array[:, 3] *= np.cbrt(np.linalg.det(matrix[:3, :3]))
+
+    def filter(self, mask: NDArray) -> 'Spherization':
+        # Parent indices refer to the previous level and stay valid; filtering a level orphans its children.
+        return Spherization(
+            self.array[mask],
+            self.mean_error,
+            self.best_error,
+            self.worst_error,
+            None if self.parents is None else self.parents[mask],
+            self.method,
+            )
+
+
+@dataclass(slots = True)
+class SphereHierarchy:
+    array: NDArray          # (N, 4) spheres level by level, the children of each sphere next to each other
+    first_child: NDArray    # (N, ) index of each sphere's first child
+    child_count: NDArray    # (N, ) number of children, 0 at the leaves
+    roots: int              # The first `roots` spheres have no parent
+
+    def __len__(self) -> int:
+        return len(self.array)
 
+    def children(self, index: int) -> NDArray:
+        return self.array[self.first_child[index]:self.first_child[index] + self.child_count[index]]
+
+
+def _infer_parents(level: Spherization, previous: NDArray) -> NDArray:
+    # Spheres without a known parent hang off the sphere of the previous level that would need to grow least
+    # to contain them.
+    parents = np.full(len(level), -1) if level.parents is None else level.parents.copy()
+    orphans = parents < 0
+    if orphans.any():
+        growth = np.linalg.norm(level.centers[orphans, None] - previous[None, :, :3], axis = -1)
+        growth += level.radii[orphans, None] - previous[None, :, 3]
+        parents[orphans] = np.argmin(growth, axis = 1)
+
+    return parents
+
+
+def sphere_hierarchy(trees: list[list[Spherization]]) -> SphereHierarchy:
+    # Merges the levels of one or more sphere-trees, e.g., of every collision of a link, into one bounding
+    # volume hierarchy. Parents are refit to enclose their children, so a query that misses a sphere can skip
+    # everything below it.
+    levels = []
+    parents = []
+    for depth in range(max(map(len, trees), default = 0)):
+        tree_levels = [tree[depth] for tree in trees if depth < len(tree)]
+        if depth == 0:
+            parents.append(np.full(sum(map(len, tree_levels)), -1))
+        else:
+            level_parents = []
+            offset = 0
+            for tree in trees:
+                if depth < len(tree):
+                    level_parents.append(_infer_parents(tree[depth], tree[depth - 1].array) + offset)
+                if depth - 1 < len(tree):
+                    offset += len(tree[depth - 1])
+
+            parents.append(np.concatenate(level_parents))
+
+        levels.append(np.concatenate([level.array for level in tree_levels]).reshape(-1, 4))
+
+    # Children are grouped by parent; parents are renumbered to follow their own level's new order.
+    order = np.arange(len(levels[0])) if levels else np.arange(0)
+    for depth in range(1, len(levels)):
+        rank = np.empty_like(order)
+        rank[order] = np.arange(len(order))
+        parents[depth] = rank[parents[depth]]
+        order = np.argsort(parents[depth], kind = 'stable')
+        levels[depth] = levels[depth][order]
+        parents[depth] = parents[depth][order]
+
+    for depth in range(len(levels) - 1, 0, -1):
+        child, parent = levels[depth], levels[depth - 1]
+        reach = np.linalg.norm(child[:, :3] - parent[parents[depth], :3], axis = 1) + child[:, 3]
+        np.maximum.at(parent[:, 3], parents[depth], reach)
+
+    starts = np.cumsum([0] + [len(level) for level in levels])
+    first_child = np.full(starts[-1], starts[-1])
+    child_count = np.zeros(starts[-1], dtype = int)
+    for depth in range(1, len(levels)):
+        counts = np.bincount(parents[depth], minlength = len(levels[depth - 1]))
+        child_count[starts[depth - 1]:starts[depth]] = counts
+        first_child[starts[depth - 1]:starts[depth]] = starts[depth] + np.cumsum(counts) - counts
+
+    array = np.concatenate(levels) if levels else np.zeros((0, 4))
+    return SphereHierarchy(array, first_child, child_count, len(levels[0]) if levels else 0)
+
+
+def save_sphere_hierarchies(hierarchies: dict[str, SphereHierarchy], filename: Path):
+    # One `.npz` for the whole robot: the spheres of link `links[i]` are `spheres[link_offsets[i]:link_offsets[i
+    # + 1]]` and child indices are global, so every array can be used as is without unpacking per link.
+    values = list(hierarchies.values())
+    offsets = np.cumsum([0] + [len(h) for h in values])
+    np.savez(
+        filename,
+        links = np.array(list(hierarchies.keys()), dtype = str),
+        link_offsets = offsets,
+        link_roots = np.array([h.roots for h in values], dtype = int),
+        spheres = np.concatenate([np.zeros((0, 4))] + [h.array for h in values]),
+        first_child = np.concatenate([np.zeros(0, dtype = int)] + [h.first_child + o for h, o in zip(values, offsets)]),
+        child_count = np.concatenate([np.zeros(0, dtype = int)] + [h.child_count for h in values]),
+        )
+
+
+@dataclass
+class SweepCandidate:
+    spherization: Spherization
+    parameters: dict[str, Any]    # Spherization kwargs that differ from the mesh's defaults
+    runtime: float                # CPU seconds of the run that produced it, external binaries included
 
 
 class SphereEncoder(JSONEncoder):
 
     def default(self, obj):
         if isinstance(obj, Sphere):
-            return {'origin': list(obj.origin), 'radius': obj.radius}
+            return {'origin': obj.origin.tolist(), 'radius': obj.radius}
         if isinstance(obj, Spherization):
-            return {
+            encoded = {
                 'mean': obj.mean_error,
                 'best': obj.best_error,
                 'worst': obj.worst_error,
-                'spheres': obj.spheres
+                'spheres': obj.array.tolist()
                 }
+            if obj.method is not None:
+                encoded['method'] = obj.method
+            if obj.parents is not None:
+                encoded['parents'] = obj.parents.tolist()
+
+            return encoded
+        if isinstance(obj, SweepCandidate):
+            return {'spherization': obj.spherization, 'parameters': obj.parameters, 'runtime': obj.runtime}
 
         return JSONEncoder.default(self, obj)
 
@@ -66,6 +250,22 @@ class SphereDecoder(JSONDecoder):
             return Sphere(*dct['origin'], dct['radius']) # type: ignore
 
         if 'mean' in dct and 'best' in dct and 'worst' in dct and 'spheres' in dct:
-            return Spherization(dct['spheres'], dct['mean'], dct['best'], dct['worst'])
+            # Spheres are stored as `[x, y, z, r]` rows; older files stored one object per sphere.
+            spheres = dct['spheres']
+            if spheres and isinstance(spheres[0], Sphere):
+                return Spherization(spheres, dct['mean'], dct['best'], dct['worst'], method = dct.get('method'))
+
+            parents = dct.get('parents')
+            return Spherization(
+                np.array(spheres, dtype = np.float64),
+                dct['mean'],
+                dct['best'],
+                dct['worst'],
+                None if parents is None else np.array(parents, dtype = int),
+                dct.get('method'),
+                )
+
+        if 'spherization' in dct and 'parameters' in dct and 'runtime' in dct:
+            return SweepCandidate(dct['spherization'], dct['parameters'], dct['runtime'])
 
         return dct
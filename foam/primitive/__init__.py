@@ -0,0 +1,126 @@
+from trimesh.base import Trimesh
+from trimesh.primitives import Box, Cylinder
+from trimesh.primitives import Sphere as TMSphere
+
+import numpy as np
+from numpy.typing import NDArray
+
+from foam.model import *
+
+
+def _fibonacci_directions(n: int) -> NDArray:
+    i = np.arange(n) + 0.5
+    z = 1 - 2 * i / n
+    theta = np.pi * (1 + 5**0.5) * i
+    rho = np.sqrt(1 - z**2)
+    return np.stack([rho * np.cos(theta), rho * np.sin(theta), z], axis = 1)
+
+
+# Directions used to find how far each sphere protrudes from the primitive it covers.
+ERROR_DIRECTIONS = _fibonacci_directions(64)
+
+
+def _box_distance(points: NDArray, extents: NDArray) -> NDArray:
+    return np.linalg.norm(np.maximum(np.abs(points) - extents / 2, 0.), axis = -1)
+
+
+def _cylinder_distance(points: NDArray, radius: float, height: float) -> NDArray:
+    radial = np.maximum(np.linalg.norm(points[..., :2], axis = -1) - radius, 0.)
+    axial = np.maximum(np.abs(points[..., 2]) - height / 2, 0.)
+    return np.hypot(radial, axial)
+
+
+def _spherization(spheres: NDArray, distance) -> Spherization:
+    # Each sphere's error is the furthest its surface gets from the primitive, as for the makeTree binaries.
+    surface = spheres[:, None, :3] + spheres[:, None, 3:] * ERROR_DIRECTIONS[None]
+    errors = distance(surface).max(axis = 1)
+    return Spherization(spheres, float(errors.mean()), float(errors.min()), float(errors.max()))
+
+
+def _box_grid(extents: NDArray, target: int) -> NDArray:
+    # Greedily split the longest cell edge while the cell count stays within the target.
+    cells = np.ones(3, dtype = int)
+    while True:
+        for axis in np.argsort(-extents / cells):
+            if np.prod(cells) // cells[axis] * (cells[axis] + 1) <= target:
+                cells[axis] += 1
+                break
+        else:
+            return cells
+
+
+def spherize_box(extents: NDArray, depth: int = 1, branch: int = 8) -> list[Spherization]:
+    extents = np.asarray(extents, dtype = np.float64)
+    levels = []
+    for level in range(depth + 1):
+        cells = _box_grid(extents, branch**level)
+        size = extents / cells
+
+        # Every cell of the grid is circumscribed by one sphere.
+        axes = [(np.arange(n) + 0.5) * s - e / 2 for n, s, e in zip(cells, size, extents)]
+        centers = np.stack(np.meshgrid(*axes, indexing = 'ij'), axis = -1).reshape(-1, 3)
+        radii = np.full((len(centers), 1), np.linalg.norm(size) / 2)
+
+        levels.append(_spherization(np.hstack([centers, radii]), lambda p: _box_distance(p, extents)))
+
+    return levels
+
+
+def spherize_cylinder(radius: float, height: float, depth: int = 1, branch: int = 8) -> list[Spherization]:
+    levels = []
+    for level in range(depth + 1):
+        target = branch**level
+
+        # The cylinder is cut into `slices` along its axis and each slice into `sectors` around it. A sector
+        # with half-angle a is covered by a circle of radius r / (2 cos a) centered that far out along its
+        # bisector; one or two sectors are best covered by the disc itself.
+        sectors = np.arange(1, target + 1)
+        slices = target // sectors
+        sector_radius = np.where(sectors < 3, radius, radius / (2 * np.cos(np.pi / np.maximum(sectors, 3))))
+        sphere_radius = np.hypot(sector_radius, height / (2 * slices))
+
+        best = np.argmin(sphere_radius)
+        m, n, r = sectors[best], slices[best], sphere_radius[best]
+
+        offset = 0. if m < 3 else sector_radius[best]
+        angles = 2 * np.pi * np.arange(m) / m
+        z = (np.arange(n) + 0.5) * height / n - height / 2
+        centers = np.stack(
+            [
+                np.tile(offset * np.cos(angles), n),
+                np.tile(offset * np.sin(angles), n),
+                np.repeat(z, m),
+                ],
+            axis = 1,
+            )
+        radii = np.full((len(centers), 1), r)
+
+        levels.append(
+            _spherization(np.hstack([centers, radii]), lambda p: _cylinder_distance(p, radius, height))
+            )
+
+    return levels
+
+
+def spherize_sphere(radius: float, depth: int = 1) -> list[Spherization]:
+    # NOTE: Because depth seems to be 0-indexed and determines the number of fineness levels for the spherization
+    return [Spherization(np.array([[0., 0., 0., radius]]), 0.0, 0.0, 0.0) for _ in range(depth + 1)]
+
+
+def is_primitive(mesh: Trimesh) -> bool:
+    return isinstance(mesh, (Box, Cylinder, TMSphere))
+
+
+def spherize_primitive(mesh: Box | Cylinder | TMSphere, depth: int = 1, branch: int = 8) -> list[Spherization]:
+    if isinstance(mesh, Box):
+        levels = spherize_box(mesh.primitive.extents, depth, branch)
+    elif isinstance(mesh, Cylinder):
+        levels = spherize_cylinder(mesh.primitive.radius, mesh.primitive.height, depth, branch)
+    else:
+        levels = spherize_sphere(mesh.primitive.radius, depth)
+
+    # Primitives keep their scale in their dimensions, so this transform is always rigid.
+    for spherization in levels:
+        spherization.transform(mesh.primitive.transform)
+
+    return levels
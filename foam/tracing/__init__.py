@@ -0,0 +1,137 @@
+from json import dumps as jsdumps
+from os import getpid
+from pathlib import Path
+from resource import getrusage, RUSAGE_CHILDREN, RUSAGE_SELF
+from threading import get_ident
+from time import perf_counter
+
+# Finished spans of this process. Worker processes hand theirs back with each job result, see `traced_call`.
+SPANS: list[dict] = []
+
+TRACING = False
+
+
+def enable_tracing(enabled: bool = True):
+    global TRACING
+    TRACING = enabled
+
+
+def tracing_enabled() -> bool:
+    return TRACING
+
+
+class Span:
+    # A timed stage. `perf_counter` reads the system-wide monotonic clock on Linux, so spans recorded in
+    # different processes share one timeline.
+
+    __slots__ = ('record', 'start', 'child_cpu')
+
+    def __init__(self, name: str, attributes: dict):
+        self.record = {'name': name, 'pid': getpid(), 'tid': get_ident(), 'attributes': attributes}
+
+    def set(self, **attributes):
+        self.record['attributes'].update(attributes)
+
+    def __enter__(self) -> 'Span':
+        usage = getrusage(RUSAGE_CHILDREN)
+        self.child_cpu = usage.ru_utime + usage.ru_stime
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, exception_type, *_):
+        end = perf_counter()
+        usage = getrusage(RUSAGE_CHILDREN)
+
+        # Child usage is per process, so concurrent threads each see the others' subprocesses as well. Pool
+        # workers run one job at a time, where this is exact.
+        self.record['start'] = self.start
+        self.record['duration'] = end - self.start
+        self.record['child_cpu'] = usage.ru_utime + usage.ru_stime - self.child_cpu
+        self.record['child_max_rss_kb'] = usage.ru_maxrss
+        self.record['max_rss_kb'] = getrusage(RUSAGE_SELF).ru_maxrss
+        if exception_type is not None:
+            self.record['error'] = exception_type.__name__
+
+        SPANS.append(self.record)
+
+
+class NullSpan:
+    # Shared stand-in returned while tracing is off, so instrumented code pays for one global lookup.
+
+    __slots__ = ()
+
+    def set(self, **attributes):
+        pass
+
+    def __enter__(self) -> 'NullSpan':
+        return self
+
+    def __exit__(self, *_):
+        pass
+
+
+NULL_SPAN = NullSpan()
+
+
+def span(name: str, **attributes) -> Span | NullSpan:
+    if not TRACING:
+        return NULL_SPAN
+
+    return Span(name, attributes)
+
+
+def mesh_size(mesh) -> dict[str, int]:
+    return {'vertices': len(mesh.vertices), 'faces': len(mesh.faces)}
+
+
+def collect_spans() -> list[dict]:
+    spans = SPANS[:]
+    del SPANS[:len(spans)]
+    return spans
+
+
+def add_spans(spans: list[dict]):
+    SPANS.extend(spans)
+
+
+def traced_call(fn, args: tuple, tracing: bool, collect: bool, name: str) -> tuple:
+    # Runs a pool job, returning `(result, spans)`. Process workers do not share `SPANS` with the pool's owner,
+    # so when `collect` is set the spans recorded during the job travel back with its result.
+    if not tracing:
+        return fn(*args), None
+
+    enable_tracing()
+    with span('job', key = name):
+        result = fn(*args)
+
+    return result, collect_spans() if collect else None
+
+
+def export_json(filename: Path, spans: list[dict] | None = None):
+    with open(filename, 'w') as f:
+        f.write(jsdumps(SPANS if spans is None else spans, indent = 4))
+
+
+def export_chrome_trace(filename: Path, spans: list[dict] | None = None):
+    # Complete events in the Trace Event Format, viewable in chrome://tracing or Perfetto. Each worker process
+    # gets its own row, so gaps between `job` spans show idle workers.
+    spans = SPANS if spans is None else spans
+    origin = min((s['start'] for s in spans), default = 0.)
+    events = [
+        {
+            'name': s['name'],
+            'ph': 'X',
+            'ts': (s['start'] - origin) * 1e6,
+            'dur': s['duration'] * 1e6,
+            'pid': s['pid'],
+            'tid': s['tid'],
+            'args': s['attributes'] | {
+                'child_cpu': s['child_cpu'],
+                'child_max_rss_kb': s['child_max_rss_kb'],
+                'max_rss_kb': s['max_rss_kb'],
+                },
+            } for s in spans
+        ]
+
+    with open(filename, 'w') as f:
+        f.write(jsdumps({'traceEvents': events, 'displayTimeUnit': 'ms'}))
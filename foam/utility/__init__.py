@@ -1,23 +1,33 @@
 from collections.abc import Iterator
 from contextlib import contextmanager
-from dataclasses import dataclass, field
+from dataclasses import dataclass
+from functools import lru_cache
+from hashlib import blake2b
+from os import W_OK, access
+from os import replace as replace_file
 from pathlib import Path
+from re import sub as resub
 from tempfile import NamedTemporaryFile
+from time import perf_counter
+from xml.sax.saxutils import quoteattr
 from typing import Any
 from numpy.typing import NDArray
 
 from trimesh.base import Trimesh
+from trimesh.convex import hull_points
 from trimesh.scene.scene import Scene
 from trimesh.util import concatenate
 from trimesh.exchange.load import load_mesh
 from trimesh.repair import *
-from trimesh.smoothing import filter_humphrey, filter_taubin
 from trimesh.primitives import Box, Cylinder
 from trimesh.primitives import Sphere as TMSphere
 
 import numpy as np
 
 import xmltodict
+from scipy.sparse import csr_matrix
+
+from foam.tracing import *
 
 
 def fix_mesh(mesh: Trimesh):
@@ -27,19 +37,174 @@ def fix_mesh(mesh: Trimesh):
     mesh.vertex_normals = -mesh.vertex_normals
 
 
-def smooth_mesh(mesh: Trimesh):
-    filter_humphrey(mesh, iterations = 100)
+@dataclass
+class SmoothingStats:
+    iterations: int
+    seconds: float
+    displacement: float    # Largest vertex move in the last iteration, relative to the bounding box diagonal
+
+
+def mesh_laplacian(mesh: Trimesh) -> csr_matrix:
+    # Umbrella operator averaging each vertex's neighbors, built straight from the unique edges. Vertices without
+    # neighbors stay where they are.
+    edges = mesh.edges_unique
+    count = len(mesh.vertices)
+    rows = np.concatenate([edges[:, 0], edges[:, 1]])
+    columns = np.concatenate([edges[:, 1], edges[:, 0]])
+
+    degree = np.bincount(rows, minlength = count)
+    isolated = np.flatnonzero(degree == 0)
+    rows = np.concatenate([rows, isolated])
+    columns = np.concatenate([columns, isolated])
+    degree[isolated] = 1
+
+    return csr_matrix((1. / degree[rows], (rows, columns)), shape = (count, count))
+
+
+def smooth_mesh(
+        mesh: Trimesh,
+        iterations: int = 100,
+        tolerance: float = 1e-5,
+        alpha: float = 0.1,
+        beta: float = 0.5,
+    ) -> SmoothingStats:
+    # Humphrey's classes smoothing, as `trimesh.smoothing.filter_humphrey`, but stopping early once no vertex
+    # moves more than `tolerance` times the bounding box diagonal in an iteration.
+    with span('smooth', **mesh_size(mesh)) as stage:
+        start = perf_counter()
+        laplacian = mesh_laplacian(mesh)
+        diagonal = max(float(np.linalg.norm(mesh.extents)), 1e-12)
+
+        original = np.array(mesh.vertices, dtype = np.float64)
+        vertices = original.copy()
+        displacement = 0.
+        iteration = 0
+        while iteration < iterations:
+            iteration += 1
+            previous = vertices
+            vertices = laplacian @ previous
+            difference = vertices - (alpha * original + (1. - alpha) * previous)
+            vertices -= beta * difference + (1. - beta) * (laplacian @ difference)
+
+            displacement = float(np.abs(vertices - previous).max(initial = 0.)) / diagonal
+            if displacement <= tolerance:
+                break
+
+        mesh.vertices = vertices
+        stats = SmoothingStats(iteration, perf_counter() - start, displacement)
+        stage.set(iterations = stats.iterations, displacement = stats.displacement)
+
+    return stats
+
+
+def hash_file(filepath: Path, *arrays: NDArray | None) -> str:
+    # Content hash of a mesh file together with whatever is applied to it on load, e.g., its scale.
+    digest = blake2b(digest_size = 16)
+    with open(filepath, 'rb') as f:
+        while chunk := f.read(1 << 20):
+            digest.update(chunk)
+
+    for array in arrays:
+        digest.update(b'-' if array is None else np.asarray(array, dtype = np.float64).tobytes())
+
+    return digest.hexdigest()
+
+
+def hash_mesh(mesh: Trimesh) -> str:
+    digest = blake2b(digest_size = 16)
+    digest.update(np.ascontiguousarray(mesh.vertices, dtype = np.float64).tobytes())
+    digest.update(np.ascontiguousarray(mesh.faces, dtype = np.int64).tobytes())
+    return digest.hexdigest()
+
+
+def bounding_sphere(mesh: Trimesh, tolerance: float = 0.05) -> tuple[NDArray, float]:
+    # Bounding sphere of the convex hull with a radius at most `1 + tolerance` times the minimum, after Badoiu and
+    # Clarkson: the center repeatedly steps towards the farthest hull vertex. Unlike the exact furthest-site Voronoi
+    # fit, time and memory only grow linearly with the size of the hull.
+    points = hull_points(mesh)
+    center = points.mean(axis = 0)
+    for i in range(1, int(np.ceil(tolerance**-2)) + 1):
+        farthest = points[np.argmax(((points - center)**2).sum(axis = 1))]
+        center += (farthest - center) / (i + 1)
+
+    return center, float(np.sqrt(((points - center)**2).sum(axis = 1).max()))
+
+
+# Meshes handed to the external binaries go to RAM-backed scratch space when the platform has one. The binaries
+# only accept (and write next to) OBJ paths, so a pipe or memfd is not an option.
+SCRATCH_DIR = Path('/dev/shm') if Path('/dev/shm').is_dir() and access('/dev/shm', W_OK) else None
 
 
 @contextmanager
 def tempmesh():
-    f = NamedTemporaryFile('w', suffix = f'.obj')
+    f = NamedTemporaryFile('w', suffix = f'.obj', dir = SCRATCH_DIR)
     try:
         yield f, Path(f.name)
     finally:
         f.close()
 
 
+def export_obj_fast(mesh: Trimesh, normals: bool = False) -> str:
+    vertices = mesh.vertices
+    faces = mesh.faces + 1
+
+    parts = [('v %.8f %.8f %.8f\n' * len(vertices)) % tuple(vertices.ravel().tolist())]
+    if normals:
+        parts.append(('vn %.8f %.8f %.8f\n' * len(vertices)) % tuple(mesh.vertex_normals.ravel().tolist()))
+        parts.append(('f %d//%d %d//%d %d//%d\n' * len(faces)) % tuple(np.repeat(faces.ravel(), 2).tolist()))
+    else:
+        parts.append(('f %d %d %d\n' * len(faces)) % tuple(faces.ravel().tolist()))
+
+    return ''.join(parts)
+
+
+def read_obj(mesh_filepath: Path) -> Trimesh:
+    lines = mesh_filepath.read_bytes().splitlines()
+    vertex_lines = [line[2:] for line in lines if line.startswith(b'v ')]
+    face_lines = [line[2:] for line in lines if line.startswith(b'f ')]
+    if not face_lines:
+        raise RuntimeError("Failed to load mesh!")
+
+    vertices = np.fromstring(b' '.join(vertex_lines).decode(), sep = ' ')
+    # Keep only the vertex index of `v/vt/vn` face entries.
+    faces = np.fromstring(resub(rb'/\S*', b'', b' '.join(face_lines)).decode(), sep = ' ', dtype = np.int64)
+
+    # Anything beyond plain triangles (vertex colors, polygons, ...) goes through the general loader.
+    if vertices.size != 3 * len(vertex_lines) or faces.size != 3 * len(face_lines):
+        return _load_mesh_file(mesh_filepath)
+
+    return Trimesh(vertices = vertices.reshape(-1, 3), faces = faces.reshape(-1, 3) - 1, process = False)
+
+
+class MeshFile:
+    # A mesh serialized once to scratch space, so consecutive external stages can share a single copy instead of
+    # each exporting the mesh again. Created without a mesh, it is an empty output file for a binary to write.
+
+    def __init__(self, mesh: Trimesh | None = None, normals: bool = True):
+        self.file = NamedTemporaryFile('w', suffix = '.obj', dir = SCRATCH_DIR)
+        self.path = Path(self.file.name)
+        self.mesh = mesh
+
+        if mesh is not None:
+            self.file.write(export_obj_fast(mesh, normals))
+            self.file.flush()
+
+    def __enter__(self) -> 'MeshFile':
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def load(self) -> Trimesh:
+        if self.mesh is None:
+            self.mesh = read_obj(self.path)
+
+        return self.mesh
+
+    def close(self):
+        self.file.close()
+
+
 def as_mesh(scene_or_mesh: Trimesh | Scene) -> Trimesh | None:
     if isinstance(scene_or_mesh, Scene):
         if len(scene_or_mesh.geometry) == 0:
@@ -52,7 +217,7 @@ def as_mesh(scene_or_mesh: Trimesh | Scene) -> Trimesh | None:
         return scene_or_mesh
 
 
-def load_mesh_file(mesh_filepath: Path) -> Trimesh:
+def _load_mesh_file(mesh_filepath: Path) -> Trimesh:
     try:
         mesh = as_mesh(load_mesh(mesh_filepath, process = False)) # type: ignore
         if mesh is None:
@@ -64,10 +229,71 @@ def load_mesh_file(mesh_filepath: Path) -> Trimesh:
         raise e
 
 
+# Loaded meshes are cached by file identity, so a file referenced by several collisions or reloaded by a script is
+# only parsed once per process. With a cache directory set, the arrays are also kept on disk as `.npy` files, which
+# later processes memory-map instead of parsing the file again.
+MESH_CACHE_SIZE = 32
+MESH_CACHE_DIR: Path | None = None
+
+
+def set_mesh_cache_dir(directory: Path | None):
+    global MESH_CACHE_DIR
+    if directory is not None:
+        directory.mkdir(parents = True, exist_ok = True)
+
+    MESH_CACHE_DIR = directory
+
+
+def get_mesh_cache_dir() -> Path | None:
+    return MESH_CACHE_DIR
+
+
+def _save_array(filepath: Path, array: NDArray):
+    # Each writer gets its own temporary file, so workers caching the same mesh at once never mix their writes.
+    with NamedTemporaryFile('wb', dir = filepath.parent, prefix = filepath.name, delete = False) as f:
+        np.save(f, array)
+
+    replace_file(f.name, filepath)
+
+
+@lru_cache(maxsize = MESH_CACHE_SIZE)
+def _mesh_arrays(mesh_filepath: Path, mtime: int, size: int, cache_dir: Path | None) -> tuple[NDArray, NDArray]:
+    if cache_dir is not None:
+        stem = f"{blake2b(str(mesh_filepath).encode(), digest_size = 16).hexdigest()}-{mtime}-{size}"
+        vertices_filepath = cache_dir / f"{stem}-vertices.npy"
+        faces_filepath = cache_dir / f"{stem}-faces.npy"
+        if vertices_filepath.exists() and faces_filepath.exists():
+            return np.load(vertices_filepath, mmap_mode = 'r'), np.load(faces_filepath, mmap_mode = 'r')
+
+    mesh = _load_mesh_file(mesh_filepath)
+    vertices = np.array(mesh.vertices, dtype = np.float64)
+    faces = np.array(mesh.faces, dtype = np.int64)
+    vertices.setflags(write = False)
+    faces.setflags(write = False)
+
+    if cache_dir is not None:
+        _save_array(vertices_filepath, vertices)
+        _save_array(faces_filepath, faces)
+
+    return vertices, faces
+
+
+def load_mesh_file(mesh_filepath: Path) -> Trimesh:
+    # Every call gets its own copy of the cached arrays, so callers are free to transform the mesh in place.
+    mesh_filepath = Path(mesh_filepath).resolve()
+    stat = mesh_filepath.stat()
+    with span('load', path = str(mesh_filepath)) as stage:
+        vertices, faces = _mesh_arrays(mesh_filepath, stat.st_mtime_ns, stat.st_size, MESH_CACHE_DIR)
+        mesh = Trimesh(vertices = np.array(vertices), faces = np.array(faces), process = False)
+        stage.set(**mesh_size(mesh))
+
+    return mesh
+
+
 @dataclass
 class URDFMesh:
     name: str
-    mesh: Trimesh
+    mesh: Trimesh | Path    # A path until loaded, see `iter_urdf_meshes`
     xyz: NDArray
     rpy: NDArray
     scale: NDArray
@@ -147,10 +373,11 @@ def get_urdf_primitives(urdf: URDFDict, shrinkage: float = 1.) -> list[URDFPrimi
     return primitives
 
 
-def get_urdf_meshes(urdf: URDFDict, shrinkage: float = 1.) -> list[URDFMesh]:
+def iter_urdf_meshes(urdf: URDFDict, shrinkage: float = 1.) -> Iterator[URDFMesh]:
+    # Yields each collision mesh as soon as it is found, with the file path in place of the mesh so whoever
+    # spherizes it can load it when (and where) it is needed.
     urdf_dir = Path(urdf['robot']['@path']).parent
 
-    meshes = []
     for link in urdf['robot']['link']:
         name = link['@name']
         if 'collision' not in link:
@@ -175,9 +402,14 @@ def get_urdf_meshes(urdf: URDFDict, shrinkage: float = 1.) -> list[URDFMesh]:
                 filename = _urdf_clean_filename(mesh['@filename'])
                 scale = _urdf_array_to_np(mesh['@scale']) if 'scale' in mesh else np.array([1., 1., 1.])
                 scale *= shrinkage # HACK: need to scale down to get some tight self collision working
-                meshes.append(URDFMesh(f"{name}::{filename}", load_mesh_file(urdf_dir / filename), xyz, rpy, scale))
+                yield URDFMesh(f"{name}::{filename}", urdf_dir / filename, xyz, rpy, scale)
 
-    return meshes
+
+def get_urdf_meshes(urdf: URDFDict, shrinkage: float = 1.) -> list[URDFMesh]:
+    return [
+        URDFMesh(mesh.name, load_mesh_file(mesh.mesh), mesh.xyz, mesh.rpy, mesh.scale)
+        for mesh in iter_urdf_meshes(urdf, shrinkage)
+        ]
 
 
 def get_urdf_spheres(urdf: URDFDict) -> Iterator[tuple[float, float, float, float]]:
@@ -205,49 +437,56 @@ def get_urdf_spheres(urdf: URDFDict) -> Iterator[tuple[float, float, float, floa
                 yield *xyz.tolist(), radius
 
 
-def set_urdf_spheres(urdf: URDFDict, spheres):
-    total_spheres = 0
-    for link in urdf['robot']['link']:
-        name = link['@name']
-        if 'collision' not in link:
-            continue
+def _link_spherizations(link: URDFDict, spheres) -> list:
+    # Spherizations of a link's collisions, in the order the collisions appear. Meshes are keyed
+    # `link::filename`, primitives `link::primitive<index>`.
+    name = link['@name']
+    collisions = link['collision']
 
-        collisions = link['collision']
+    if not isinstance(collisions, list):
+        collisions = [collisions]
 
-        if not isinstance(collisions, list):
-            collisions = [collisions]
+    spherizations = []
+    for i, collision in enumerate(collisions):
 
-        spherizations = []
-        for i, collision in enumerate(collisions):
+        geometry = collision['geometry']
 
-            geometry = collision['geometry']
+        if 'box' in geometry or 'cylinder' in geometry or 'sphere' in geometry:
+            key = f"{name}::primitive{i}"
+            if key in spheres:
+                spherizations.append(spheres[key])
 
-            if 'box' in geometry or 'cylinder' in geometry or 'sphere' in geometry:
-                key = f"{name}::primitive{i}"
-                if key in spheres:
-                    spherizations.append(spheres[key])
+        elif 'mesh' in geometry:
+            mesh = geometry['mesh']
+            filename = _urdf_clean_filename(mesh['@filename'])
+            key = f"{name}::{filename}"
 
-            elif 'mesh' in geometry:
-                mesh = geometry['mesh']
-                filename = _urdf_clean_filename(mesh['@filename'])
-                key = f"{name}::{filename}"
+            if key in spheres:
+                spherizations.append(spheres[key])
+
+    return spherizations
 
-                if key in spheres:
-                    spherizations.append(spheres[key])
+
+def set_urdf_spheres(urdf: URDFDict, spheres):
+    total_spheres = 0
+    for link in urdf['robot']['link']:
+        if 'collision' not in link:
+            continue
 
         collision = []
-        for spherization in spherizations:
-            for sphere in spherization.spheres:
-                total_spheres += 1
+        for spherization in _link_spherizations(link, spheres):
+            total_spheres += len(spherization)
+            for x, y, z, r in spherization.array.tolist():
                 collision.append(
-                    {
+                    # Collisions are named after the method that produced them, where known.
+                    ({} if spherization.method is None else {'@name': spherization.method}) | {
                         'geometry': {
                             'sphere': {
-                                '@radius': sphere.radius
+                                '@radius': r
                                 }
                             },
                         'origin': {
-                            '@xyz': ' '.join(map(str, sphere.origin)), '@rpy': '0 0 0'
+                            '@xyz': f'{x} {y} {z}', '@rpy': '0 0 0'
                             }
                         }
                     )
@@ -259,3 +498,126 @@ def set_urdf_spheres(urdf: URDFDict, spheres):
 def save_urdf(urdf: URDFDict, filename: Path):
     with open(filename, 'w') as f:
         f.write(xmltodict.unparse(urdf, pretty = True))
+
+
+def _open_tag(tag: str, element: URDFDict) -> str:
+    attributes = ''.join(f' {key[1:]}={quoteattr(str(value))}' for key, value in element.items() if key[0] == '@')
+    return f'<{tag}{attributes}>'
+
+
+def _sphere_collisions(spherization, precision: int) -> str:
+    # One format string for all spheres of a spherization, instead of a dict and an unparse per sphere.
+    name = '' if spherization.method is None else f' name={quoteattr(spherization.method)}'
+    template = (
+        f'\t\t<collision{name}>\n'
+        '\t\t\t<geometry>\n'
+        f'\t\t\t\t<sphere radius="%.{precision}f"></sphere>\n'
+        '\t\t\t</geometry>\n'
+        f'\t\t\t<origin xyz="%.{precision}f %.{precision}f %.{precision}f" rpy="0 0 0"></origin>\n'
+        '\t\t</collision>\n'
+        )
+    return (template * len(spherization)) % tuple(spherization.array[:, [3, 0, 1, 2]].ravel().tolist())
+
+
+def save_spherized_urdf(urdf: URDFDict, spheres, filename: Path, precision: int = 6):
+    # Writes the URDF with every link's collisions replaced by its spheres, as `set_urdf_spheres` and `save_urdf`
+    # would, but link by link and without building the spheres into `urdf`, which is left unchanged.
+    total_spheres = 0
+    robot = urdf['robot']
+    with open(filename, 'w') as f:
+        f.write('<?xml version="1.0" encoding="utf-8"?>\n')
+        f.write(_open_tag('robot', robot) + '\n')
+
+        for key, value in robot.items():
+            if key[0] == '@':
+                continue
+
+            if key != 'link':
+                f.write(xmltodict.unparse({key: value}, full_document = False, pretty = True, depth = 1))
+                continue
+
+            for link in value if isinstance(value, list) else [value]:
+                if 'collision' not in link:
+                    f.write(xmltodict.unparse({'link': link}, full_document = False, pretty = True, depth = 1))
+                    continue
+
+                body = []
+                for child, element in link.items():
+                    if child == 'collision':
+                        for spherization in _link_spherizations(link, spheres):
+                            total_spheres += len(spherization)
+                            body.append(_sphere_collisions(spherization, precision))
+                    elif child[0] != '@':
+                        body.append(
+                            xmltodict.unparse({child: element}, full_document = False, pretty = True, depth = 2)
+                            )
+
+                body = ''.join(body)
+                f.write(f'\t{_open_tag("link", link)}' + (f'\n{body}\t</link>\n' if body else '</link>\n'))
+
+        f.write('</robot>')
+
+    print(f"spheres: {total_spheres}")
+
+
+def sphere_bank(urdf: URDFDict, spheres) -> tuple[list[str], NDArray, NDArray]:
+    # Every link's spheres in one (S, 4) array, in URDF link order: link `links[i]` holds
+    # `array[offsets[i]:offsets[i + 1]]`. Links without spheres have empty ranges.
+    links = urdf['robot']['link']
+    links = links if isinstance(links, list) else [links]
+
+    arrays = [
+        [spherization.array for spherization in _link_spherizations(link, spheres)] if 'collision' in link else []
+        for link in links
+        ]
+    counts = [sum(len(array) for array in link_arrays) for link_arrays in arrays]
+    array = np.concatenate([np.zeros((0, 4))] + [array for link_arrays in arrays for array in link_arrays])
+    return [link['@name'] for link in links], np.cumsum([0] + counts), array
+
+
+def save_sphere_bank(urdf: URDFDict, spheres, filename: Path, dtype = np.float32):
+    # Uncompressed, so each array is stored as is and loads without any parsing.
+    links, offsets, array = sphere_bank(urdf, spheres)
+    np.savez(filename, links = np.array(links, dtype = str), link_offsets = offsets, spheres = array.astype(dtype))
+
+
+def _c_float(value: float) -> str:
+    literal = f'{value:.9g}'
+    return literal + ('f' if '.' in literal or 'e' in literal else '.f')
+
+
+def _c_string(text: str) -> str:
+    # Quotes, backslashes and anything but printable ASCII become octal escapes, which never run into the next
+    # character the way hexadecimal ones can.
+    return '"' + ''.join(
+        c if c.isascii() and c.isprintable() and c not in '"\\' else ''.join(f'\\{b:03o}' for b in c.encode())
+        for c in text
+        ) + '"'
+
+
+def save_sphere_header(urdf: URDFDict, spheres, filename: Path):
+    # A C/C++ header with the sphere bank as constant arrays, for planners that compile the robot model in.
+    links, offsets, array = sphere_bank(urdf, spheres)
+    robot = ' '.join(urdf['robot'].get('@name', '').split()) or 'robot'
+    prefix = resub(r'\W', '_', robot)
+    if prefix[0].isdigit():
+        prefix = f'_{prefix}'
+
+    names = ', '.join(map(_c_string, links))
+    link_offsets = ', '.join(map(str, offsets))
+    # C does not allow empty arrays, so a robot without spheres gets one zero sphere past the end of the bank.
+    rows = ',\n'.join('    {' + ', '.join(map(_c_float, row)) + '}' for row in array.tolist())
+    rows = rows or '    {0.f, 0.f, 0.f, 0.f}'
+
+    with open(filename, 'w') as f:
+        f.write(
+            f'// Sphere model of {robot}, generated by foam.\n'
+            '#pragma once\n\n'
+            f'#define {prefix.upper()}_NUM_LINKS {len(links)}\n'
+            f'#define {prefix.upper()}_NUM_SPHERES {len(array)}\n\n'
+            f'// Spheres of link i are {prefix}_spheres[{prefix}_link_offsets[i]] up to '
+            f'{prefix}_spheres[{prefix}_link_offsets[i + 1]], as {{x, y, z, radius}}.\n'
+            f'static const char *const {prefix}_link_names[{len(links)}] = {{{names}}};\n'
+            f'static const unsigned int {prefix}_link_offsets[{len(links) + 1}] = {{{link_offsets}}};\n'
+            f'static const float {prefix}_spheres[{max(len(array), 1)}][4] = {{\n{rows}\n}};\n'
+            )
@@ -0,0 +1,206 @@
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import asdict
+from glob import glob
+from json import dumps
+from json import load as jsload
+from multiprocessing import get_context
+from os import cpu_count, wait4
+from pathlib import Path
+from platform import platform
+from resource import getrusage, RUSAGE_CHILDREN, RUSAGE_SELF
+from subprocess import Popen, DEVNULL
+from sys import executable
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+from fire import Fire
+
+import foam.external
+from foam import *
+
+GENERATE_SPHERE_URDF = Path(__file__).parent / "generate_sphere_urdf.py"
+
+
+def run_key(run: dict) -> tuple:
+    return (run['kind'], run['target'], run['method'], run['branch'], run['depth'], run['threads'])
+
+
+def mesh_run(mesh: str, method: str, branch: int, depth: int, evaluate: bool) -> dict:
+    # Runs in a fresh process, so peak RSS and the subprocess count belong to this run alone.
+    record = {
+        'kind': 'mesh',
+        'target': mesh,
+        'method': method,
+        'branch': branch,
+        'depth': depth,
+        'threads': 1,
+        }
+
+    start = perf_counter()
+    try:
+        levels = spherize_mesh(
+            mesh,
+            Path(mesh),
+            spherization_kwargs = {
+                'method': method,
+                'branch': branch,
+                'depth': depth,
+                },
+            )
+        record['wall'] = perf_counter() - start
+        record['spheres'] = len(levels[-1])
+
+        if evaluate:
+            record['quality'] = asdict(evaluate_spherization(load_mesh_file(Path(mesh)), levels[-1]))
+
+    except Exception as e:
+        record['wall'] = perf_counter() - start
+        record['error'] = str(e)
+
+    record['peak_rss_kb'] = max(getrusage(RUSAGE_SELF).ru_maxrss, getrusage(RUSAGE_CHILDREN).ru_maxrss)
+    record['subprocesses'] = foam.external.EXTERNAL_RUNS
+    return record
+
+
+def fresh_process(fn, *args):
+    # A single use pool per call, as `max_tasks_per_child` needs Python 3.11.
+    with ProcessPoolExecutor(max_workers = 1, mp_context = get_context('spawn')) as pool:
+        return pool.submit(fn, *args).result()
+
+
+def urdf_run(urdf: str, method: str, branch: int, depth: int, threads: int) -> dict:
+    record = {
+        'kind': 'urdf',
+        'target': urdf,
+        'method': method,
+        'branch': branch,
+        'depth': depth,
+        'threads': threads,
+        }
+
+    # Every run starts from an empty database so nothing is served from the cache.
+    with TemporaryDirectory() as scratch:
+        start = perf_counter()
+        process = Popen(
+            [
+                executable,
+                str(GENERATE_SPHERE_URDF),
+                '--filename',
+                urdf,
+                '--output',
+                str(Path(scratch) / 'spherized.urdf'),
+                '--database',
+                str(Path(scratch) / 'database.db'),
+                '--method',
+                method,
+                '--branch',
+                str(branch),
+                '--depth',
+                str(depth),
+                '--threads',
+                str(threads),
+                ],
+            stdout = DEVNULL,
+            )
+        _, status, usage = wait4(process.pid, 0)
+        record['wall'] = perf_counter() - start
+
+    if status != 0:
+        record['error'] = f"exit status {status}"
+
+    # Worker processes are not counted here; per-mesh runs report subprocess counts.
+    record['peak_rss_kb'] = usage.ru_maxrss
+    record['subprocesses'] = None
+    return record
+
+
+def compare(results: list[dict], baseline: list[dict], tolerance: float, min_delta: float) -> list[str]:
+    regressions = []
+    reference = {run_key(run): run for run in baseline}
+    for run in results:
+        base = reference.get(run_key(run))
+        if base is None:
+            continue
+
+        name = ' '.join(map(str, run_key(run)))
+        if 'error' in run and 'error' not in base:
+            regressions.append(f"{name}: now fails ({run['error']})")
+            continue
+
+        if run['wall'] > base['wall'] * (1 + tolerance) and run['wall'] - base['wall'] > min_delta:
+            regressions.append(f"{name}: wall time {base['wall']:.2f}s -> {run['wall']:.2f}s")
+
+        if 'quality' in run and 'quality' in base:
+            before = base['quality']['surface_coverage']
+            after = run['quality']['surface_coverage']
+            if after < before - 0.01:
+                regressions.append(f"{name}: surface coverage {before:.3f} -> {after:.3f}")
+
+    return regressions
+
+
+def main(
+        meshes: str = "assets/panda/meshes/collision/*.obj",
+        urdfs: str = "assets/panda/panda.urdf",
+        methods: tuple[str, ...] = ("medial", "grid", "spawn", "octree", "hubbard"),
+        branches: tuple[int, ...] = (8, ),
+        depths: tuple[int, ...] = (1, ),
+        threads: tuple[int, ...] = (1, 4),
+        output: str = "benchmark.json",
+        baseline: str = "benchmark_baseline.json",
+        update_baseline: bool = False,
+        tolerance: float = 0.25,
+        min_delta: float = 0.5,
+        evaluate: bool = True,
+    ):
+    mesh_files = sorted(glob(meshes))
+    urdf_files = sorted(glob(urdfs))
+
+    results = []
+    for mesh in mesh_files:
+        for method in methods:
+            for branch in branches:
+                for depth in depths:
+                    run = fresh_process(mesh_run, mesh, method, branch, depth, evaluate)
+                    print(f"{mesh} {method} b{branch} d{depth}: {run['wall']:.2f}s")
+                    results.append(run)
+
+    for urdf in urdf_files:
+        for method in methods:
+            for branch in branches:
+                for depth in depths:
+                    for thread_count in threads:
+                        run = urdf_run(urdf, method, branch, depth, thread_count)
+                        print(f"{urdf} {method} b{branch} d{depth} t{thread_count}: {run['wall']:.2f}s")
+                        results.append(run)
+
+    report = {'platform': platform(), 'cpus': cpu_count(), 'runs': results}
+    with open(output, 'w') as f:
+        f.write(dumps(report, indent = 4))
+
+    baseline_filepath = Path(baseline)
+    if update_baseline:
+        with open(baseline_filepath, 'w') as f:
+            f.write(dumps(report, indent = 4))
+
+        print(f"Updated baseline {baseline}")
+        return
+
+    # Without a baseline nothing could be checked, which must not pass for a clean run.
+    if not baseline_filepath.exists():
+        raise SystemExit(f"No baseline at {baseline}, run with --update_baseline to create one")
+
+    with open(baseline_filepath, 'r') as f:
+        regressions = compare(results, jsload(f)['runs'], tolerance, min_delta)
+
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+
+    if regressions:
+        raise SystemExit(1)
+
+    print("No regressions against baseline")
+
+
+if __name__ == "__main__":
+    Fire(main)
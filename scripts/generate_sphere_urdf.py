@@ -4,13 +4,11 @@ from fire import Fire
 
 from foam import *
 
-from trimesh.primitives import Sphere
-from trimesh.nsphere import minimum_nsphere
 
 def main(
         filename: str = "assets/panda/panda.urdf",
         output: str = "spherized.urdf",
-        database: str = "sphere_database.json",
+        database: str = "sphere_database.db",
         depth: int = 1,
         branch: int = 8,
         method: str = "medial",
@@ -33,110 +31,84 @@ def main(
         volume_heuristic_ratio: float = 0.7,
         manifold_leaves: int = 1000,
         simplification_ratio: float = 0.2,
+        face_budget: int | None = None,
+        decimation_tolerance: float = 0.005,
+        smoothing_faces: int | None = None,
+        budget: float | None = None,
+        urdf_budget: float | None = None,
         threads: int = 16,
+        processes: bool = True,
+        timeout: float | None = None,
+        trace: str | None = None,
+        chrome_trace: str | None = None,
+        mesh_cache: str | None = None,
+        hierarchy: str | None = None,
+        prune: float | None = None,
+        precision: int = 6,
+        bank: str | None = None,
+        header: str | None = None,
         shrinkage: float = 1.,
         **kwargs: float
     ):
 
-    sh = SpherizationHelper(Path(database), threads)
-
-    urdf = load_urdf(Path(filename))
-    meshes = get_urdf_meshes(urdf, shrinkage)
-
-    for mesh in meshes:
-
-        # branch_value = max(
-        #     int(mesh.mesh.volume * 10000 * volume_heuristic_ratio), branch
-        #     ) if use_volume_heuristic else branch
-
-        center, radius = minimum_nsphere(mesh.mesh.vertices)
-        vr = Sphere(radius, center).volume / mesh.mesh.volume
-        branch_value = min(int(vr * volume_heuristic_ratio), branch)
-
-        key = mesh.name.split(":")[0]
-        if key in kwargs:
-            branch_value = int(kwargs[key] * branch_value)
-
-        print(f"Link::Mesh: {mesh.name}\n  Target Spheres: {branch_value}")
-
-        sh.spherize_mesh(
-            mesh.name,
-            mesh.mesh,
-            mesh.scale,
-            mesh.xyz,
-            method,
-            mesh.rpy,
-            depth=depth,
-            branch=branch_value,
-            testerLevels=testerLevels,
-            numCover=numCover,
-            minCover=minCover,
-            initSpheres=initSpheres,
-            minSpheres=minSpheres,
-            erFact=erFact,
-            expand=expand,
-            merge=merge,
-            burst=burst,
-            optimise=optimise,
-            maxOptLevel=maxOptLevel,
-            balExcess=balExcess,
-            verify=verify,
-            num_samples=num_samples,
-            min_samples=min_samples,        
-            manifold_leaves=manifold_leaves,
-            simplification_ratio=simplification_ratio,
-
-            )
-
-    primitives = get_urdf_primitives(urdf, shrinkage)
-    for primitive in primitives:
-        center, radius = minimum_nsphere(primitive.mesh.vertices)
-        vr = Sphere(radius, center).volume / primitive.mesh.volume
-        branch_value = min(int(vr * volume_heuristic_ratio), branch)
-
-        key = primitive.name.split(":")[0]
-        if key in kwargs:
-            branch_value = int(kwargs[key] * branch_value)
-
-        print(primitive.name, vr, branch_value)
-
-        sh.spherize_mesh(
-            primitive.name,
-            primitive.mesh,
-            primitive.scale,
-            primitive.xyz,
-            method,
-            primitive.rpy,
-            depth=depth,
-            branch=branch_value,
-            testerLevels=testerLevels,
-            numCover=numCover,
-            minCover=minCover,
-            initSpheres=initSpheres,
-            minSpheres=minSpheres,
-            erFact=erFact,
-            expand=expand,
-            merge=merge,
-            burst=burst,
-            optimise=optimise,
-            maxOptLevel=maxOptLevel,
-            balExcess=balExcess,
-            verify=verify,
-            num_samples=num_samples,
-            min_samples=min_samples,        
-            manifold_leaves=manifold_leaves,
-            simplification_ratio=simplification_ratio,
-
-            )
-
-    mesh_spheres = {mesh.name: sh.get_spherization(mesh.name, depth, branch) for mesh in meshes}
-    primitive_spheres = {
-        primitive.name: sh.get_spherization(primitive.name, depth, branch, cache = False)
-        for primitive in primitives
-        }
-
-    set_urdf_spheres(urdf, mesh_spheres | primitive_spheres)
-    save_urdf(urdf, Path(output))
+    if trace or chrome_trace:
+        enable_tracing()
+
+    if mesh_cache:
+        set_mesh_cache_dir(Path(mesh_cache))
+
+    timeouts = {stage: timeout for stage in ('makeTree', 'manifold', 'simplify')} if timeout else {}
+    sh = SpherizationHelper(Path(database), threads, processes, timeouts)
+
+    job = queue_urdf(
+        sh,
+        Path(filename),
+        Path(output),
+        depth,
+        branch,
+        shrinkage,
+        volume_heuristic_ratio,
+        kwargs,
+        urdf_budget,
+        method=method,
+        testerLevels=testerLevels,
+        numCover=numCover,
+        minCover=minCover,
+        initSpheres=initSpheres,
+        minSpheres=minSpheres,
+        erFact=erFact,
+        expand=expand,
+        merge=merge,
+        burst=burst,
+        optimise=optimise,
+        maxOptLevel=maxOptLevel,
+        balExcess=balExcess,
+        verify=verify,
+        num_samples=num_samples,
+        min_samples=min_samples,
+        manifold_leaves=manifold_leaves,
+        simplification_ratio=simplification_ratio,
+        face_budget=face_budget,
+        decimation_tolerance=decimation_tolerance,
+        smoothing_faces=smoothing_faces,
+        budget=budget,
+        )
+
+    if hierarchy:
+        job.hierarchy = Path(hierarchy)
+
+    job.prune = prune
+    job.precision = precision
+    job.bank = Path(bank) if bank else None
+    job.header = Path(header) if header else None
+
+    write_urdf(sh, job)
+
+    if trace:
+        export_json(Path(trace))
+
+    if chrome_trace:
+        export_chrome_trace(Path(chrome_trace))
 
 
 if __name__ == "__main__":
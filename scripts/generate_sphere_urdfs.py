@@ -0,0 +1,99 @@
+from glob import glob
+from pathlib import Path
+
+from fire import Fire
+
+from foam import *
+
+
+def main(
+        urdfs: str | list[str] = "assets/**/*.urdf",
+        output_dir: str = "spherized",
+        database: str = "sphere_database.db",
+        depth: int = 1,
+        branch: int = 8,
+        volume_heuristic_ratio: float = 0.7,
+        shrinkage: float = 1.,
+        link_scales: dict[str, float] = {},
+        urdf_budget: float | None = None,
+        threads: int = 16,
+        processes: bool = True,
+        timeout: float | None = None,
+        trace: str | None = None,
+        chrome_trace: str | None = None,
+        mesh_cache: str | None = None,
+        hierarchy: bool = False,
+        prune: float | None = None,
+        precision: int = 6,
+        bank: bool = False,
+        header: bool = False,
+        **spherize_kwargs,
+    ):
+    # Any other option, e.g. `--method`, `--numCover`, `--face_budget` or `--budget`, is passed on for every mesh.
+    patterns = [urdfs] if isinstance(urdfs, str) else urdfs
+    filenames = sorted({Path(filename) for pattern in patterns for filename in glob(pattern, recursive = True)})
+    if not filenames:
+        raise RuntimeError(f"No URDFs match {urdfs}!")
+
+    outputs = [Path(output_dir) / filename.name for filename in filenames]
+    if len(set(outputs)) != len(outputs):
+        raise RuntimeError("URDFs with the same file name would overwrite each other's output!")
+
+    Path(output_dir).mkdir(parents = True, exist_ok = True)
+
+    if trace or chrome_trace:
+        enable_tracing()
+
+    if mesh_cache:
+        set_mesh_cache_dir(Path(mesh_cache))
+
+    timeouts = {stage: timeout for stage in ('makeTree', 'manifold', 'simplify')} if timeout else {}
+    sh = SpherizationHelper(Path(database), threads, processes, timeouts)
+
+    # Everything is queued up front, so jobs shared between robots are deduplicated and ranked together.
+    jobs = [
+        queue_urdf(
+            sh,
+            filename,
+            output,
+            depth,
+            branch,
+            shrinkage,
+            volume_heuristic_ratio,
+            link_scales,
+            urdf_budget,
+            **spherize_kwargs,
+            ) for filename, output in zip(filenames, outputs)
+        ]
+
+    # Exports of each robot go next to its URDF.
+    for job in jobs:
+        job.prune = prune
+        job.precision = precision
+        if hierarchy:
+            job.hierarchy = job.output.with_suffix('.npz')
+        if bank:
+            job.bank = job.output.with_suffix('.bank.npz')
+        if header:
+            job.header = job.output.with_suffix('.h')
+
+    failed = 0
+    for job, error in write_urdfs(sh, jobs):
+        if error is None:
+            print(f"Wrote {job.output}")
+        else:
+            print(f"Failed to spherize {job.urdf['robot']['@path']}: {error}")
+            failed += 1
+
+    if trace:
+        export_json(Path(trace))
+
+    if chrome_trace:
+        export_chrome_trace(Path(chrome_trace))
+
+    if failed:
+        raise RuntimeError(f"{failed} of {len(jobs)} URDFs failed!")
+
+
+if __name__ == "__main__":
+    Fire(main)
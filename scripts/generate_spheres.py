@@ -30,6 +30,8 @@ def main(
         balExcess: float = 0.05,
         verify: bool = True,
         eval: bool = False,
+        min_coverage: float = 0.,
+        max_hausdorff: float | None = None,
         num_samples: int = 500,
         min_samples: int = 1
     ):
@@ -85,6 +87,23 @@ def main(
     with open(output, 'w') as f:
         f.write(dumps(spheres, indent=4, cls=SphereEncoder))
 
+    if eval:
+        scaled_mesh = load_mesh_file(mesh_filepath)
+        scaled_mesh.apply_scale(scale)
+
+        failed = False
+        for level, spherization in enumerate(spheres):
+            quality = evaluate_spherization(scaled_mesh, spherization)
+            print(f"Level {level}: {quality}")
+
+            if quality.surface_coverage < min_coverage:
+                failed = True
+            if max_hausdorff is not None and quality.hausdorff > max_hausdorff:
+                failed = True
+
+        if failed:
+            raise RuntimeError("Spherization quality below the requested thresholds!")
+
     end_time = time.time()
 
     print(f"Generated spheres in {end_time - start_time:.6f} seconds")
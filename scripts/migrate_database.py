@@ -0,0 +1,18 @@
+from pathlib import Path
+
+from fire import Fire
+
+from foam import *
+
+
+def main(source: str = "sphere_database.json", destination: str = "sphere_database.db"):
+    source_filepath = Path(source)
+    if not source_filepath.exists():
+        raise RuntimeError(f"Path {source} does not exist!")
+
+    migrated = migrate_database(source_filepath, Path(destination))
+    print(f"Migrated {migrated} entries from {source} to {destination}")
+
+
+if __name__ == "__main__":
+    Fire(main)
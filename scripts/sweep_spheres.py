@@ -0,0 +1,49 @@
+from pathlib import Path
+
+from fire import Fire
+
+from foam import *
+
+
+def main(
+        filename: str = "assets/panda/panda.urdf",
+        database: str = "sphere_database.db",
+        grid: dict[str, list] = {
+            'method': ["medial", "grid", "spawn", "octree", "hubbard"],
+            'branch': [4, 8, 16],
+            'numCover': [2000, 5000],
+            },
+        samples: int | None = None,
+        budget: float = 600.,
+        seed: int = 0,
+        output: str | None = None,
+        target_count: int | None = None,
+        target_error: float | None = None,
+        threads: int = 16,
+        processes: bool = True,
+        timeout: float | None = None,
+        **spherize_kwargs,
+    ):
+    timeouts = {stage: timeout for stage in ('makeTree', 'manifold', 'simplify')} if timeout else {}
+    sh = SpherizationHelper(Path(database), threads, processes, timeouts)
+
+    # Meshes are only registered; the sweep decides which parameters they are spherized with.
+    job = queue_urdf(sh, Path(filename), Path(output or "spherized.urdf"), queue = False, **spherize_kwargs)
+    fronts = sh.sweep(grid, budget, samples, seed = seed)
+
+    for name, front in fronts.items():
+        print(name)
+        for candidate in front:
+            print(
+                f"  {len(candidate.spherization)} spheres, mean error {candidate.spherization.mean_error:.5f}, "
+                f"{candidate.runtime:.1f}s: {candidate.parameters}"
+                )
+
+    if output:
+        job.target_count = target_count
+        job.target_error = target_error
+        write_urdf(sh, job)
+
+
+if __name__ == "__main__":
+    Fire(main)
@@ -30,10 +30,10 @@ def main(mesh: str, spheres: str | None = None, depth: int = 1):
             raise RuntimeError(f"Depth {depth} greater than available ({len(data)})!")
 
         cm = mpl.colormaps['viridis']
-        for sphere in spherization[depth].spheres:
-            sphere_mesh = icosphere(radius = sphere.radius)
+        for *origin, radius in spherization[depth].array.tolist():
+            sphere_mesh = icosphere(radius = radius)
             sphere_mesh.visual.face_colors = [255 * c for c in cm(random.uniform(0, 1))][:3] + [100]
-            scene.add_geometry(sphere_mesh, transform = translation_matrix(sphere.origin))
+            scene.add_geometry(sphere_mesh, transform = translation_matrix(origin))
 
     SceneViewer(scene)
 